@@ -2,13 +2,20 @@
 import os
 import re
 import json
+import fcntl
 import time
 import atexit
 import shutil
+import signal
 import fnmatch
+import hashlib
 import logging
 import argparse
+import threading
 from datetime import datetime
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 # Third party libs
 import docker
@@ -17,10 +24,84 @@ import pandas as pd
 
 # Local imports
 from s3interface import Database
+from containers import ContainerPool, ContainerEventRunner, CpusetAllocator, allocate_cpus, parse_cpus
+from resultcache import ResultCache
+from jobqueue import JobQueue
+from cluster import Coordinator, Worker, cluster_authkey, parse_address
 
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 
 
+class SubmissionLog(logging.Filter):
+    """Hold back the log records of a grading thread until its submission
+    is done, so that concurrently graded submissions don't interleave"""
+    local = threading.local()
+    lock = threading.Lock()
+
+    def filter(self, record):
+        records = getattr(self.local, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+    @classmethod
+    @contextmanager
+    def capture(cls):
+        cls.local.records = []
+        try:
+            yield
+        finally:
+            records, cls.local.records = cls.local.records, None
+            with cls.lock:
+                for record in records:
+                    logging.getLogger().handle(record)
+
+
+logging.getLogger().addFilter(SubmissionLog())
+
+# ioctl to clone a file's data blocks, see: man ioctl_ficlone
+FICLONE = 0x40049409
+
+
+def compile_patterns(patterns):
+    """Compile UNIX-style filename patterns into a single regex"""
+    return re.compile('|'.join(fnmatch.translate(p) for p in patterns) or r'(?!)')
+
+
+class ProjectManifest:
+    """Plan of how to setup a code dir from a project dir. The project tree is
+    walked and filtered against the excluded patterns once, then every code dir
+    is set up by replaying the plan. Each file is given the setup mode to use,
+    see Grader.setup_file"""
+    def __init__(self, project_dir, excluded, setup_mode, always_copied):
+        self.project_dir = project_dir
+        self.dirs, self.files = [], []
+        self.walk('', excluded, setup_mode, always_copied)
+
+    def walk(self, rel_dir, excluded, setup_mode, always_copied):
+        entries = sorted(os.scandir(os.path.join(self.project_dir, rel_dir)), key=lambda e: e.name)
+        for entry in entries:
+            if excluded.match(entry.name) or entry.is_symlink():
+                continue
+            rel_path = os.path.join(rel_dir, entry.name)
+            if entry.is_file():
+                mode = 'copy' if always_copied.match(entry.name) else setup_mode
+                self.files.append((rel_path, mode, entry.stat().st_size))
+            elif entry.is_dir():
+                self.dirs.append(rel_path)
+                self.walk(rel_path, excluded, setup_mode, always_copied)
+
+    def report(self):
+        """Human readable version of the plan"""
+        total = sum(size for _, _, size in self.files)
+        lines = [f'Setup plan for {self.project_dir}: {len(self.dirs)} dirs, '
+                 f'{len(self.files)} files, {total / 2**20:.1f} MB']
+        lines += [f'  mkdir {rel_path}' for rel_path in self.dirs]
+        lines += [f'  {mode:<7} {rel_path} ({size / 2**10:.1f} KB)' for rel_path, mode, size in self.files]
+        return '\n'.join(lines)
+
+
 class Grader(Database):
     def __init__(self, projects, netid, *args, grader_config_path=None,
                  s3_config_path=None, **kwargs):
@@ -33,45 +114,154 @@ class Grader(Database):
         self.projects = projects
         self.netid = None if netid.strip() == '?' else netid
         self.stats = pd.DataFrame()
+        self.stats_rows, self.list_times = [], []
+        self.stats_lock = threading.Lock()
+        self.started, self.closed = time.time(), False
+        # Bound the number of live containers when grading concurrently
+        max_containers = self.conf.MAX_CONTAINERS or self.conf.WORKERS
+        # Resource limits of every container, and cpus to pin them to
+        self.limits = self.container_limits()
+        self.cpusets = None
+        if self.conf.CPUS_PER_CONTAINER:
+            self.cpusets = CpusetAllocator(parse_cpus(self.conf.CPUS), self.conf.CPUS_PER_CONTAINER)
+            if max_containers > self.cpusets.capacity:
+                logging.warning(f'Only {self.cpusets.capacity} containers can be pinned to '
+                                f'{self.conf.CPUS_PER_CONTAINER} cpus each, running at most that many')
+                max_containers = self.cpusets.capacity
+        self.container_slots = threading.BoundedSemaphore(max_containers)
+        # In link mode, project files are symlinks to a read-only mount of the semester dir
+        self.semester_dir = f'../{self.conf.SEMESTER}/'
+        self.excluded = compile_patterns(self.conf.EXCLUDED_FILES)
+        self.manifests = {}
+        # Snapshot of each project dir the manifests and hashes were built from
+        self.project_stamps = {}
+        self.refresh_lock, self.next_refresh = threading.Lock(), 0
+        self.volumes = {}
+        if self.conf.SETUP_MODE == 'link':
+            self.volumes[os.path.abspath(self.semester_dir)] = {'bind': self.conf.PROJECTS_MOUNT, 'mode': 'ro'}
+        self.pool = ContainerPool(max_containers, timeout=self.conf.TIMEOUT, volumes=self.volumes,
+                                  limits=self.limits, cpusets=self.cpusets) if self.conf.WARM_POOL else None
+        self.event_runner = ContainerEventRunner(timeout=self.conf.TIMEOUT, max_containers=max_containers,
+                                                 volumes=self.volumes, limits=self.limits,
+                                                 cpusets=self.cpusets) if self.conf.EVENT_DRIVEN else None
+        # Results of identical submissions are reused from the cache
+        self.cache = ResultCache(self.conf.CACHE_DIR, self.conf.CACHE_MAX_MB * 2**20) if self.conf.CACHE_DIR else None
+        self.project_hashes = {}
+        # Scores of previous results, loaded up front when keeping the best result
+        self.previous_scores = {}
+        self.image_id = None
+        # Live metrics, served over http if a port is given
+        self.done_times = deque()
+        self.register_metrics()
+        self.metrics_server = self.metrics.serve(self.conf.METRICS_PORT) if self.conf.METRICS_PORT else None
         # Log what config is being used
         logging.info('Using configuration:')
         logging.info(json.dumps(self.conf, indent=2, ensure_ascii=True, sort_keys=True))
         atexit.register(self.close)
 
+    # Buckets of the container latency histogram, in seconds
+    LATENCY_BUCKETS = [1, 2, 5, 10, 20, 30, 60, 120, 180, 300]
+    # Throughput is averaged over this many seconds
+    THROUGHPUT_WINDOW = 60
+
+    def register_metrics(self):
+        self.metrics.gauge('grader_submissions_queued', 'Submissions listed but not started yet')
+        self.metrics.gauge('grader_submissions_in_flight', 'Submissions being fetched, set up, tested or saved')
+        self.metrics.counter('grader_submissions_done_total', 'Submissions graded')
+        self.metrics.counter('grader_submissions_failed_total', 'Submissions that failed to be graded')
+        self.metrics.counter('grader_submissions_timed_out_total', 'Submissions whose tests timed out')
+        self.metrics.histogram('grader_container_seconds', 'Time from starting a container to its exit',
+                               self.LATENCY_BUCKETS)
+        self.metrics.gauge('grader_throughput', f'Submissions graded per second over the last '
+                                                f'{self.THROUGHPUT_WINDOW}s', fn=self.throughput)
+
+    def throughput(self):
+        """Submissions graded per second, over the last THROUGHPUT_WINDOW seconds"""
+        now = time.time()
+        with self.stats_lock:
+            while self.done_times and self.done_times[0] < now - self.THROUGHPUT_WINDOW:
+                self.done_times.popleft()
+            done = len(self.done_times)
+        return done / max(min(self.THROUGHPUT_WINDOW, now - self.started), 1)
+
+    def grading_failed(self):
+        self.metrics.dec('grader_submissions_in_flight')
+        self.metrics.inc('grader_submissions_failed_total')
+
+    def container_limits(self):
+        """Keyword arguments of containers.run limiting the resources of a container"""
+        limits = {}
+        if self.conf.CPU_LIMIT:
+            limits['nano_cpus'] = int(self.conf.CPU_LIMIT * 1e9)
+        if self.conf.MEMORY_LIMIT:
+            # Same memory and memory+swap limits, so that containers can't swap
+            limits['mem_limit'] = limits['memswap_limit'] = self.conf.MEMORY_LIMIT
+        if self.conf.PIDS_LIMIT:
+            limits['pids_limit'] = self.conf.PIDS_LIMIT
+        return limits
+
     def run_test_in_docker(self, code_dir, image='grader', cwd='/code',
-                           submission_fname=None):
+                           submission_fname=None, stats=None):
         """Run tests in a detached container with attached volume code_dir
         and working directory cdw. Wait timeout seconds for container, then
-        save results and logs, remove container and volumes"""
-        shared_dir = {os.path.abspath(code_dir): {'bind': cwd, 'mode': 'rw'}}
-        client = docker.from_env()
-
-        # Run in docker container
-        t0 = time.time()
+        save results and logs, remove container and volumes.
+        With a warm pool the tests run in one of its containers instead.
+        Phase timings, the exit code and whether it timed out are put in stats"""
+        stats = {} if stats is None else stats
         if submission_fname:
             cmd = self.conf.TEST_CMD + ' ' + submission_fname
         else:
             cmd = self.conf.TEST_CMD
 
-        container = client.containers.run(image, cmd, detach=True,
-                                          volumes=shared_dir,
-                                          working_dir=cwd)
-        logging.info(f'CONTAINER {container.id}')
+        if self.pool is not None:
+            # Run in a warm container from the pool
+            t0 = time.time()
+            logs, timed_out = self.pool.run(code_dir, cmd, self.conf.RESULT_FILE, stats)
+            t1 = time.time()
+            logs = self.parse_logs(logs)
+            if timed_out:
+                logs = 'Timeout Exceeded. Infinite loop maybe?'
+                logging.info(f'TIMEOUT EXCEEDED')
+            stats['timed_out'] = timed_out
+            with self.timed(stats, 'result_parse'):
+                return self.collect_result(code_dir, logs, t1 - t0)
 
-        try:
-            container.wait(timeout=self.conf.TIMEOUT)
-            logs = self.parse_logs(container.logs())
-        except (ConnectionError, ReadTimeout):
-            container.stop()
-            logs = 'Timeout Exceeded. Infinite loop maybe?'
-            logging.info(f'TIMEOUT EXCEEDED')
+        shared_dir = {os.path.abspath(code_dir): {'bind': cwd, 'mode': 'rw'}, **self.volumes}
+        client = docker.from_env()
 
-        t1 = time.time()
+        # Run in docker container
+        t0 = time.time()
+        with self.container_slots, allocate_cpus(self.cpusets) as cpuset:
+            with self.timed(stats, 'container_start'):
+                container = client.containers.run(image, cmd, detach=True,
+                                                  volumes=shared_dir,
+                                                  working_dir=cwd,
+                                                  cpuset_cpus=cpuset,
+                                                  **self.limits)
+            logging.info(f'CONTAINER {container.id}')
 
-        # Remove container
-        container.remove(v=True)
+            try:
+                with self.timed(stats, 'test_run'):
+                    status = container.wait(timeout=self.conf.TIMEOUT)
+                stats['exit_code'] = status['StatusCode']
+                logs = self.parse_logs(container.logs())
+            except (ConnectionError, ReadTimeout):
+                container.stop()
+                logs = 'Timeout Exceeded. Infinite loop maybe?'
+                logging.info(f'TIMEOUT EXCEEDED')
+                stats['timed_out'] = True
 
-        # Get results
+            t1 = time.time()
+
+            # Remove container
+            container.remove(v=True)
+
+        with self.timed(stats, 'result_parse'):
+            return self.collect_result(code_dir, logs, t1 - t0)
+
+    def collect_result(self, code_dir, logs, latency):
+        """Read the result file the tests left in code_dir, fall back to
+        a zero score with the container logs if there is none"""
         try:
             with open(os.path.join(code_dir, self.conf.RESULT_FILE)) as f:
                 result = json.load(f)
@@ -83,9 +273,19 @@ class Grader(Database):
             }
 
         result['date'] = datetime.now().strftime("%m/%d/%Y")
-        result['latency'] = t1 - t0
+        result['latency'] = latency
         return result
 
+    @staticmethod
+    @contextmanager
+    def timed(stats, phase):
+        """Add the wall time spent in the block to stats[phase]"""
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            stats[phase] = stats.get(phase, 0) + time.time() - t0
+
     @staticmethod
     def parse_logs(logs):
         """Parse docker logs to make them printable.
@@ -105,59 +305,468 @@ class Grader(Database):
                           f' {json.dumps(result, indent=2)}')
 
     def setup_codedir(self, project_dir, code_dir, overwrite_existing=False):
-        """Copy necessary files from project dir to code dir"""
-        for item in os.listdir(project_dir):
-            item_path = os.path.join(project_dir, item)
-            if not overwrite_existing and item in os.listdir(code_dir):
-                continue
-            if not self.is_excluded(item) and not os.path.islink(item):
-                if os.path.isfile(item_path):
-                    dst = os.path.join(code_dir, item)
-                    shutil.copy2(item_path, dst)
-                elif os.path.isdir(item_path):
-                    dst = os.path.join(code_dir, item)
-                    if not os.path.isdir(dst):
-                        os.mkdir(dst)
-                    self.setup_codedir(item_path, dst)
+        """Copy necessary files from project dir to code dir, by replaying
+        the project's manifest. Unless overwrite_existing, anything already
+        in the code dir (like the submission) is left untouched"""
+        try:
+            self.replay_manifest(project_dir, code_dir, overwrite_existing)
+        except FileNotFoundError:
+            # A project file was removed since the manifest was built
+            self.forget_project(project_dir)
+            self.replay_manifest(project_dir, code_dir, overwrite_existing)
+
+    def replay_manifest(self, project_dir, code_dir, overwrite_existing):
+        manifest = self.manifest(project_dir)
+        existing = set() if overwrite_existing else set(os.listdir(code_dir))
+        for rel_path in manifest.dirs:
+            if rel_path.split(os.sep)[0] not in existing:
+                os.makedirs(os.path.join(code_dir, rel_path), exist_ok=True)
+        for rel_path, mode, _ in manifest.files:
+            if rel_path.split(os.sep)[0] not in existing:
+                self.setup_file(os.path.join(project_dir, rel_path), os.path.join(code_dir, rel_path), mode)
+
+    def manifest(self, project_dir):
+        """Manifest of a project dir, built on first use"""
+        if project_dir not in self.manifests:
+            self.project_stamps.setdefault(project_dir, self.dir_stamp(project_dir))
+            self.manifests[project_dir] = ProjectManifest(project_dir, self.excluded, self.conf.SETUP_MODE,
+                                                          compile_patterns(self.conf.ALWAYS_COPIED))
+        return self.manifests[project_dir]
+
+    @staticmethod
+    def dir_stamp(directory):
+        """Names, sizes and modification times of everything in directory,
+        which change whenever a file is edited, added or removed"""
+        stamp = []
+        for root, dirs, files in os.walk(directory):
+            for name in sorted(dirs + files):
+                stat = os.lstat(os.path.join(root, name))
+                stamp.append((os.path.relpath(os.path.join(root, name), directory), stat.st_size, stat.st_mtime_ns))
+        return stamp
+
+    def refresh_projects(self):
+        """Forget the manifest and hash of project dirs that changed since
+        they were built, and the docker image id, so that edits by staff are
+        picked up by a long running grader. Checked every POLL_INTERVAL seconds"""
+        with self.refresh_lock:
+            if time.time() < self.next_refresh:
+                return
+            self.next_refresh = time.time() + self.conf.POLL_INTERVAL
+            for project_dir, stamp in list(self.project_stamps.items()):
+                if self.dir_stamp(project_dir) != stamp:
+                    logging.info(f'{project_dir} changed, rebuilding its manifest and hash')
+                    self.forget_project(project_dir)
+            self.image_id = None
+
+    def forget_project(self, project_dir):
+        self.project_stamps.pop(project_dir, None)
+        self.manifests.pop(project_dir, None)
+        self.project_hashes.pop(project_dir, None)
+
+    def setup_file(self, src, dst, mode):
+        """Make a project file available in a code dir, mode is either:
+            copy: copy the file
+            reflink: clone the file, sharing its data blocks until either copy is
+                written to (copy on write). Falls back to a copy if the
+                filesystem doesn't support it (ext4 doesn't, btrfs and xfs do)
+            link: symlink the file to where the semester dir is mounted, read-only,
+                in the container. Tests can read it but not modify it. Files matching
+                ALWAYS_COPIED are still copied: python resolves the symlink of a
+                script it runs, so a linked tester wouldn't find modules in the code dir"""
+        if mode == 'link':
+            target = os.path.relpath(src, self.semester_dir).replace(os.sep, '/')
+            if os.path.lexists(dst):
+                os.remove(dst)
+            os.symlink(f'{self.conf.PROJECTS_MOUNT}/{target}', dst)
+        elif mode == 'reflink':
+            try:
+                with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                shutil.copystat(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+        else:
+            shutil.copy2(src, dst)
+
+    def remove_codedir(self, code_dir):
+        """Remove the code dir of a graded submission when cleaning up, so
+        that only submissions being graded or prefetched take disk space"""
+        if self.conf.CLEANUP:
+            shutil.rmtree(code_dir, ignore_errors=True)
 
     def is_excluded(self, item):
         """Determine which files not to copy in setup_codedir"""
-        return any(fnmatch.fnmatch(item, p) for p in self.conf.EXCLUDED_FILES)
+        return self.excluded.match(item) is not None
+
+    def prepare_submission(self, project_id, s3path, fetched=None, stats=None):
+        """Fetch a submission and setup its code dir. If an identical submission
+        was graded before, its cached result is returned and the code dir is
+        not set up. Returns the code dir, the cache key and the cached result.
+        The fetch is skipped if `fetched`, a future from prefetch_submissions, is given.
+        The time spent waiting for the fetch and setting up is put in stats"""
+        stats = {} if stats is None else stats
+        self.metrics.dec('grader_submissions_queued')
+        self.metrics.inc('grader_submissions_in_flight')
+        with self.timed(stats, 'fetch'):
+            if fetched is not None:
+                code_dir, submission_fname = fetched.result()
+            else:
+                code_dir, submission_fname = self.fetch_submission(s3path, filename=self.conf.FORCE_FILENAME)
+        project_dir = os.path.join(self.semester_dir, project_id, '')
+        key, result = None, None
+        with self.timed(stats, 'setup'):
+            if self.cache is not None:
+                key = self.result_key(project_dir, os.path.join(code_dir, submission_fname))
+                result = self.cache.get(key)
+            if result is None:
+                self.setup_codedir(project_dir, code_dir)
+            else:
+                logging.info('Reusing result of an identical submission')
+                result['date'] = datetime.now().strftime("%m/%d/%Y")
+                stats['cached'] = True
+        return code_dir, key, result
+
+    def result_key(self, project_dir, submission_path, image='grader'):
+        """Hash everything a result depends on: the submission, the project
+        files, the test command and the docker image"""
+        if project_dir not in self.project_hashes:
+            self.project_stamps.setdefault(project_dir, self.dir_stamp(project_dir))
+            self.project_hashes[project_dir] = self.hash_dir(project_dir)
+        if self.image_id is None:
+            self.image_id = docker.from_env().images.get(image).id
+        h = hashlib.sha256()
+        for part in (self.project_hashes[project_dir], self.image_id,
+                     self.conf.TEST_CMD, os.path.basename(submission_path)):
+            h.update(part.encode('utf-8') + b'\0')
+        self.hash_file(submission_path, h)
+        return h.hexdigest()
+
+    @staticmethod
+    def hash_file(path, h):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                h.update(chunk)
+
+    def hash_dir(self, directory):
+        """Hash the names and contents of every file in directory"""
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                h.update(os.path.relpath(path, directory).encode('utf-8') + b'\0')
+                self.hash_file(path, h)
+        return h.hexdigest()
+
+    def cache_result(self, key, result):
+        """Cache a result unless the tests failed to produce one"""
+        if self.cache is not None and 'error' not in result:
+            self.cache.put(key, result)
+
+    def save_result(self, s3path, result, stats=None, on_saved=None):
+        """Log a submission's result and upload it unless in safe mode.
+        If stats are given, they are recorded along with the score and
+        the upload time once the upload is done. If given, on_saved(result) is called
+        once the result is uploaded (or spooled), right away if it isn't uploaded"""
+        stats = {} if stats is None else stats
+        on_saved = on_saved or (lambda result: None)
+        self.log_result(result)
+        new_score = result['score']
+        logging.info(f'Score: {new_score}')
+        stats['score'] = new_score
+        if not self.conf.SAFE:
+            if self.conf.KEEPBEST and new_score < self.previous_scores.get(s3path, 0):
+                logging.info(f'Skipped {s3path} because better grade exists')
+                on_saved(result)
+            else:
+                def uploaded(upload):
+                    stats.update(upload=upload.result())
+                    on_saved(result)
+                upload = self.put_submission_later('/'.join(s3path.split('/')[:-1] + ['test.json']), result)
+                upload.add_done_callback(uploaded)
+        else:
+            logging.info(f'Did not upload results, running in safe mode')
+            on_saved(result)
+        stats['total'] = time.time() - stats.get('started', time.time())
+        with self.stats_lock:
+            self.stats_rows.append(stats)
+            self.done_times.append(time.time())
+        self.metrics.dec('grader_submissions_in_flight')
+        self.metrics.inc('grader_submissions_done_total')
+        if stats.get('timed_out'):
+            self.metrics.inc('grader_submissions_timed_out_total')
+        if not stats.get('cached') and 'latency' in result:
+            self.metrics.observe('grader_container_seconds', result['latency'])
+
+    def new_stats(self, project_id):
+        """Stats of a submission, filled in as it is graded. They don't
+        identify the submission so that stats can be shared anonymously"""
+        return {'project': project_id, 'started': time.time(), 'cached': False,
+                'timed_out': False, 'exit_code': None}
+
+    def grade_submission(self, project_id, s3path, fetched=None, on_saved=None):
+        """Fetch a submission, setup its code dir, run its tests in docker
+        and upload the results, see save_result for on_saved"""
+        logging.info('========================================')
+        logging.info(s3path)
+
+        # Setup environment
+        stats = self.new_stats(project_id)
+        code_dir, key, result = self.prepare_submission(project_id, s3path, fetched, stats)
+
+        # Run tests in docker and save results
+        try:
+            if result is None:
+                result = self.run_test_in_docker(code_dir, stats=stats)
+                self.cache_result(key, result)
+            self.save_result(s3path, result, stats, on_saved)
+        finally:
+            self.remove_codedir(code_dir)
+        return result
+
+    def grade_submission_logged(self, project_id, s3path):
+        """Grade a submission from a worker thread. Its log lines are printed
+        as one block and errors don't stop the other workers"""
+        with SubmissionLog.capture():
+            try:
+                return self.grade_submission(project_id, s3path)
+            except Exception:
+                logging.exception(f'Failed to grade {s3path}')
+                self.grading_failed()
+
+    def grade_job(self, jobs, project_id, s3path):
+        """Grade a submission claimed from the job queue. The job is marked
+        done once its result is saved, failed jobs are retried up to
+        MAX_ATTEMPTS times"""
+        self.refresh_projects()
+        with SubmissionLog.capture():
+            try:
+                self.grade_submission(project_id, s3path,
+                                      on_saved=lambda result: jobs.finish(s3path, result['score']))
+            except Exception as e:
+                logging.exception(f'Failed to grade {s3path}')
+                self.grading_failed()
+                if jobs.fail(s3path, repr(e), self.conf.MAX_ATTEMPTS):
+                    self.metrics.inc('grader_submissions_queued')
+
+    def grade_submissions_evented(self, project_id, submissions):
+        """Setup the submissions' code dirs as containers become available, run
+        up to max_containers of them at once and save each result as soon as its
+        container exits"""
+        code_dirs, keys, all_stats = {}, {}, {}
+
+        def prepared_jobs():
+            for s3path, fetched in self.prefetch_submissions(submissions, filename=self.conf.FORCE_FILENAME):
+                stats = self.new_stats(project_id)
+                try:
+                    code_dir, key, result = self.prepare_submission(project_id, s3path, fetched, stats)
+                except Exception:
+                    with SubmissionLog.capture():
+                        logging.info('========================================')
+                        logging.info(s3path)
+                        logging.exception(f'Failed to grade {s3path}')
+                        self.grading_failed()
+                    continue
+                if result is None:
+                    code_dirs[s3path], keys[s3path], all_stats[s3path] = code_dir, key, stats
+                    yield s3path, code_dir, self.conf.TEST_CMD
+                    continue
+                try:
+                    with SubmissionLog.capture():
+                        logging.info('========================================')
+                        logging.info(s3path)
+                        self.save_result(s3path, result, stats)
+                except Exception:
+                    logging.exception(f'Failed to save results of {s3path}')
+                    self.grading_failed()
+                finally:
+                    self.remove_codedir(code_dir)
+
+        def on_done(s3path, logs, timed_out, latency, run_stats):
+            try:
+                return handle_done(s3path, logs, timed_out, latency, run_stats)
+            finally:
+                self.remove_codedir(code_dirs[s3path])
+
+        def handle_done(s3path, logs, timed_out, latency, run_stats):
+            stats = all_stats[s3path]
+            with SubmissionLog.capture():
+                logging.info('========================================')
+                logging.info(s3path)
+                if 'error' in run_stats:
+                    logging.error(f'Failed to grade {s3path}: {run_stats["error"]}')
+                    self.grading_failed()
+                    return None
+                stats.update(run_stats, timed_out=timed_out)
+                if timed_out:
+                    logs = 'Timeout Exceeded. Infinite loop maybe?'
+                    logging.info(f'TIMEOUT EXCEEDED')
+                else:
+                    logs = self.parse_logs(logs)
+                with self.timed(stats, 'result_parse'):
+                    result = self.collect_result(code_dirs[s3path], logs, latency)
+                self.cache_result(keys[s3path], result)
+                try:
+                    self.save_result(s3path, result, stats)
+                except Exception:
+                    logging.exception(f'Failed to save results of {s3path}')
+                    self.grading_failed()
+                return result
+
+        return self.event_runner.run(prepared_jobs(), on_done, prefetch=self.conf.PREFETCH)
 
     def run_grader(self):
         """For each project and submission, setup environment, run tests
         in docker container, save results or any error/logs"""
+        self.upload_spooled()
+        if self.conf.SHOW_PLAN:
+            for project_id in self.projects:
+                project_dir = os.path.join(self.semester_dir, project_id, '')
+                logging.info(self.manifest(project_dir).report())
         for project_id in self.projects:
-            submissions = self.get_submissions(project_id, rerun=self.conf.OVERWRITE or self.conf.KEEPBEST, email=self.netid)
-            for s3path in sorted(submissions):
-                logging.info('========================================')
-                logging.info(s3path)
+            t0 = time.time()
+            priorities = self.get_submissions(project_id, rerun=self.conf.OVERWRITE or self.conf.KEEPBEST,
+                                              email=self.netid, latest_only=self.conf.SKIP_SUPERSEDED,
+                                              with_priorities=True)
+            submissions = self.prioritize(priorities)
+            self.list_times.append(time.time() - t0)
+            self.metrics.inc('grader_submissions_queued', len(submissions))
+            if self.conf.KEEPBEST and not self.conf.SAFE:
+                self.previous_scores.update(self.fetch_all_results(submissions))
+            if self.conf.EVENT_DRIVEN:
+                self.grade_submissions_evented(project_id, submissions)
+            elif self.conf.WORKERS > 1:
+                with ThreadPoolExecutor(max_workers=self.conf.WORKERS) as executor:
+                    for s3path in submissions:
+                        executor.submit(self.grade_submission_logged, project_id, s3path)
+            else:
+                # Fetch the next submissions while the current one is being tested
+                fetched = self.prefetch_submissions(submissions, filename=self.conf.FORCE_FILENAME)
+                for s3path, future in fetched:
+                    try:
+                        self.grade_submission(project_id, s3path, future)
+                    except Exception:
+                        logging.exception(f'Failed to grade {s3path}')
+                        self.grading_failed()
+        self.close()
 
-                # Setup environment
-                code_dir, submission_fname = self.fetch_submission(s3path, filename=self.conf.FORCE_FILENAME)
-                project_dir = f'../{self.conf.SEMESTER}/{project_id}/'
-                self.setup_codedir(project_dir, code_dir)
+    def queue_submissions(self, jobs):
+        """Add the submissions without results to the job queue, returns
+        how many weren't in it yet"""
+        total = 0
+        for project_id in self.projects:
+            try:
+                priorities = self.get_submissions(project_id, rerun=False, email=self.netid,
+                                                  latest_only=self.conf.SKIP_SUPERSEDED,
+                                                  with_priorities=True)
+            except Exception:
+                logging.exception(f'Failed to list submissions of {project_id}, retrying later')
+                continue
+            added = jobs.add(project_id, priorities)
+            if added:
+                logging.info(f'Queued {added} new submissions of {project_id}')
+            total += added
+        self.save_index()
+        return total
 
-                # Run tests in docker and save results
-                result = self.run_test_in_docker(code_dir)
-                self.log_result(result)
-                new_score = result['score']
-                logging.info(f'Score: {new_score}')
-                if not self.conf.SAFE:
-                    if self.conf.KEEPBEST and new_score < self.fetch_results(s3path):
-                        logging.info(f'Skipped {s3path} because better grade exists')
-                    else:
-                        self.put_submission('/'.join(s3path.split('/')[:-1] + ['test.json']), result)
-                else:
-                    logging.info(f'Did not upload results, running in safe mode')
+    def run_daemon(self):
+        """Grade new submissions as they come in, until interrupted or terminated.
+        Every POLL_INTERVAL seconds, submissions without results are added to the
+        durable job queue, from which up to WORKERS jobs are graded at once. On
+        restart, jobs that were interrupted are graded again and finished ones are not"""
+        self.upload_spooled()
+        jobs = JobQueue(self.conf.QUEUE_FILE)
+        pending = jobs.recover()
+        logging.info(f'Resuming with {pending} pending jobs')
+        self.metrics.inc('grader_submissions_queued', pending)
+        stop, wake = threading.Event(), threading.Event()
+        def terminate(*args):
+            stop.set()
+            wake.set()
+        signal.signal(signal.SIGTERM, terminate)
+        slots = threading.BoundedSemaphore(self.conf.WORKERS)
+
+        def job_done(future):
+            slots.release()
+            wake.set()
+
+        next_poll = 0
+        with ThreadPoolExecutor(max_workers=self.conf.WORKERS) as executor:
+            try:
+                while not stop.is_set():
+                    if time.time() >= next_poll:
+                        self.metrics.inc('grader_submissions_queued', self.queue_submissions(jobs))
+                        next_poll = time.time() + self.conf.POLL_INTERVAL
+                    # Claim as many jobs as there are free workers
+                    while slots.acquire(blocking=False):
+                        job = jobs.claim()
+                        if job is None:
+                            slots.release()
+                            break
+                        executor.submit(self.grade_job, jobs, *job).add_done_callback(job_done)
+                    wake.wait(max(0, next_poll - time.time()))
+                    wake.clear()
+            except KeyboardInterrupt:
+                pass
+            logging.info('Stopping, waiting for running jobs to finish')
         self.close()
+        logging.info(f'Jobs by state: {jobs.counts()}')
+        jobs.close()
 
     def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.flush_uploads()
+        if self.pool is not None:
+            self.pool.close()
+        self.save_index()
         self.clear_caches()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+        if self.stats_rows:
+            self.stats = pd.DataFrame(self.stats_rows).drop(columns='started')
+            summary = self.stats_summary()
+            elapsed = time.time() - self.started
+            logging.info('========================================')
+            logging.info(f'Graded {len(self.stats)} submissions in {elapsed:.0f}s, '
+                         f'{len(self.stats) / elapsed:.2f} submissions/s')
+            logging.info(f'Wall time of each phase in seconds:\n{summary.to_string()}')
         if self.conf.STATS_FILE:
             # Shuffle dataframe as to anonymize submissions
             self.stats = self.stats.sample(frac=1).reset_index(drop=True)
-            self.stats.to_pickle(self.conf.STATS_FILE)
+            self.export_stats(self.conf.STATS_FILE)
+
+    PHASES = ['list', 'fetch', 'setup', 'container_start', 'test_run', 'result_parse', 'upload', 'total']
+
+    def stats_summary(self):
+        """Percentiles of the time spent in each phase. Listing is done once
+        per project, other phases once per submission"""
+        phases = {'list': pd.Series(self.list_times, dtype=float)}
+        phases.update({phase: self.stats[phase].dropna() for phase in self.PHASES if phase in self.stats})
+        summary = pd.DataFrame({
+            phase: {'count': len(times), 'p50': times.quantile(.5), 'p95': times.quantile(.95),
+                    'p99': times.quantile(.99), 'total': times.sum()}
+            for phase, times in phases.items()
+        }).T
+        summary['count'] = summary['count'].astype(int)
+        return summary
+
+    def export_stats(self, path):
+        """Save stats as parquet or feather (columnar, these need pyarrow) or csv,
+        depending on the extension of path, otherwise as a pickled dataframe.
+        The summary of phase timings is saved next to it as csv"""
+        extension = os.path.splitext(path)[1]
+        if extension == '.parquet':
+            self.stats.to_parquet(path, index=False)
+        elif extension == '.feather':
+            self.stats.to_feather(path)
+        elif extension == '.csv':
+            self.stats.to_csv(path, index=False)
+        else:
+            self.stats.to_pickle(path)
+        if not self.stats.empty:
+            self.stats_summary().to_csv(os.path.splitext(path)[0] + '_summary.csv', index_label='phase')
 
 
 if __name__ == '__main__':
@@ -178,15 +787,20 @@ if __name__ == '__main__':
                         help='run grader without uploading results to s3.')
     parser.add_argument('-d', '--s3dir', type=str, default=argparse.SUPPRESS,
                         help='directory of local s3 caches.')
+    parser.add_argument('-be', '--backend', type=str, choices=['s3', 'local'], default=argparse.SUPPRESS,
+                        help='store objects in s3 or in local files under LOCAL_ROOT')
     parser.add_argument('-c', '--cleanup', action='store_true', default=argparse.SUPPRESS,
-                        help='remove temporary s3 dir after execution')
+                        help='remove code dirs once graded and the temporary s3 dir after execution')
     rerun_group = parser.add_mutually_exclusive_group()
     rerun_group.add_argument('-o', '--overwrite', action='store_true', default=argparse.SUPPRESS,
                              help='rerun grader and overwrite any existing results.')
     rerun_group.add_argument('-k', '--keepbest', action='store_true', default=argparse.SUPPRESS,
                              help='rerun grader, only update result if better.')
     parser.add_argument('-sf', '--statsfile', type=str, dest='stats_file', default=argparse.SUPPRESS,
-                        help='save stats to file as a pickled dataframe')
+                        help='save per submission stats to file, as parquet, feather or csv '
+                             'depending on the extension or as a pickled dataframe otherwise')
+    parser.add_argument('-ss', '--skip-superseded', action='store_true', default=argparse.SUPPRESS,
+                        help='only grade the latest submission of each student')
     parser.add_argument('-x', '--exclude', type=str, nargs='*', default=argparse.SUPPRESS,
                         help='exclude files from being copied to codedir. '
                              'Accepts filenames or UNIX-style filename pattern'
@@ -196,12 +810,62 @@ if __name__ == '__main__':
                         help='force submission to have this filename')
     parser.add_argument('-t', '--timeout', type=int, default=argparse.SUPPRESS,
                         help='docker timeout in seconds')
+    parser.add_argument('-sm', '--setup-mode', type=str, choices=['copy', 'reflink', 'link'], default=argparse.SUPPRESS,
+                        help='how project files are put in code dirs: copied, reflinked (copy on write) or '
+                             'symlinked to a read-only mount of the semester dir')
+    parser.add_argument('-sp', '--show-plan', action='store_true', default=argparse.SUPPRESS,
+                        help='log how code dirs will be set up for each project')
+    parser.add_argument('-cpc', '--cpus-per-container', type=int, default=argparse.SUPPRESS,
+                        help='pin each container to this many cpus of its own')
+    parser.add_argument('-ml', '--memory-limit', type=str, default=argparse.SUPPRESS,
+                        help='memory limit of each container, like 512m or 2g')
     parser.add_argument('-tc', '--test-cmd', type=str, default=argparse.SUPPRESS,
                         help='command that docker runs to test code. Should create a result.json')
     parser.add_argument('-rf', '--result-file', type=str, default=argparse.SUPPRESS,
                         help='name of file the testing code generates')
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument('-cd', '--cache-dir', type=str, default=argparse.SUPPRESS,
+                             help='directory of cached results, reused for identical submissions')
+    cache_group.add_argument('-nc', '--no-cache', action='store_const', const=None, dest='cache_dir',
+                             default=argparse.SUPPRESS, help='always rerun tests, even for identical submissions')
+    parser.add_argument('-ri', '--reindex', action='store_true', default=argparse.SUPPRESS,
+                        help='discard the local index of s3 keys and list everything again')
+    parser.add_argument('-pf', '--prefetch', type=int, default=argparse.SUPPRESS,
+                        help='number of submissions to fetch ahead while grading')
+    parser.add_argument('-w', '--workers', type=int, default=argparse.SUPPRESS,
+                        help='number of submissions to grade concurrently')
+    parser.add_argument('-mc', '--max-containers', type=int, default=argparse.SUPPRESS,
+                        help='max number of live docker containers, defaults to the number of workers')
+    parser.add_argument('-D', '--daemon', action='store_true', default=argparse.SUPPRESS,
+                        help='keep running, grading new submissions from a durable job queue as they come in')
+    parser.add_argument('-pi', '--poll-interval', type=int, default=argparse.SUPPRESS,
+                        help='seconds between listings of new submissions in daemon mode')
+    role_group = parser.add_mutually_exclusive_group()
+    role_group.add_argument('-co', '--coordinator', action='store_const', const='coordinator', dest='cluster_role',
+                            default=argparse.SUPPRESS, help='list and schedule submissions for workers to grade')
+    role_group.add_argument('-wk', '--worker', action='store_const', const='worker', dest='cluster_role',
+                            default=argparse.SUPPRESS, help='grade submissions claimed from a coordinator')
+    parser.add_argument('-ca', '--coordinator-address', type=str, default=argparse.SUPPRESS,
+                        help='host:port the coordinator listens on and workers connect to')
+    parser.add_argument('-mp', '--metrics-port', type=int, default=argparse.SUPPRESS,
+                        help='serve live metrics in Prometheus\' text format on this port of localhost')
+    runner_group = parser.add_mutually_exclusive_group()
+    runner_group.add_argument('-wp', '--warm-pool', action='store_true', default=argparse.SUPPRESS,
+                              help='run each submission in a pre-started container instead of starting one for it')
+    runner_group.add_argument('-ed', '--event-driven', action='store_true', default=argparse.SUPPRESS,
+                              help='run many containers at once, setting up submissions as they '
+                                   'free up, and handle them as docker reports them done')
 
     grader_args = parser.parse_args()
     g = Grader(**vars(grader_args))
-    g.run_grader()
+    if g.conf.CLUSTER_ROLE == 'coordinator':
+        Coordinator(g, parse_address(g.conf.COORDINATOR_ADDRESS), cluster_authkey(g.conf)).serve(g.conf.DAEMON)
+        g.close()
+    elif g.conf.CLUSTER_ROLE == 'worker':
+        g.upload_spooled()
+        Worker(g, parse_address(g.conf.COORDINATOR_ADDRESS), cluster_authkey(g.conf)).run()
+    elif g.conf.DAEMON:
+        g.run_daemon()
+    else:
+        g.run_grader()
 
@@ -0,0 +1,182 @@
+# Standard libs
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+# Local imports
+from jobqueue import JobQueue
+
+
+def parse_address(address):
+    """Split a 'host:port' address into a (host, port) tuple"""
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def cluster_authkey(conf):
+    """Key shared by the coordinator and its workers. Messages are pickled,
+    so only processes knowing the key may connect"""
+    authkey = conf.CLUSTER_AUTHKEY or os.environ.get('GRADER_AUTHKEY')
+    if not authkey:
+        raise ValueError('Set CLUSTER_AUTHKEY or the GRADER_AUTHKEY environment variable')
+    return authkey.encode('utf-8')
+
+
+class Coordinator:
+    """Lists and schedules submissions, which worker processes claim over
+    a socket and grade with their own docker daemon. Jobs are kept in the
+    durable job queue, jobs of a worker that disconnects are queued again.
+
+    Workers send one of:
+        ('claim',): answered by ('job', project_id, s3path), ('wait', seconds)
+            when there is nothing to do yet, or ('stop',) once grading is done
+        ('done', s3path, score): once the result of a job is saved
+        ('failed', s3path, error): when a job couldn't be graded"""
+
+    # Seconds a worker waits before claiming again when the queue is empty
+    WAIT = 1
+
+    def __init__(self, grader, address, authkey):
+        self.grader = grader
+        # Workers don't list keys, and saving an index would overwrite the
+        # coordinator's (or another worker's) INDEX_FILE
+        self.grader.index = None
+        self.jobs = JobQueue(grader.conf.QUEUE_FILE)
+        self.listener = Listener(address, authkey=authkey)
+        self.stopping = threading.Event()
+        self.handlers = []
+
+    def serve(self, daemon=False):
+        """Hand out jobs until interrupted. Unless daemon, stop once
+        every submission found by the first listing is graded"""
+        logging.info(f'Coordinator listening on {self.listener.address}, '
+                      f'resuming with {self.jobs.recover()} pending jobs')
+        threading.Thread(target=self.accept, daemon=True).start()
+        next_poll = 0
+        try:
+            while daemon or next_poll == 0 or self.jobs.unfinished():
+                if time.time() >= next_poll:
+                    self.grader.queue_submissions(self.jobs)
+                    next_poll = time.time() + self.grader.conf.POLL_INTERVAL
+                time.sleep(self.WAIT)
+        except KeyboardInterrupt:
+            pass
+        logging.info('Stopping, waiting for workers to finish their jobs')
+        self.stopping.set()
+        try:
+            for handler in list(self.handlers):
+                handler.join()
+        except KeyboardInterrupt:
+            pass
+        self.listener.close()
+        logging.info(f'Jobs by state: {self.jobs.counts()}')
+        self.jobs.close()
+
+    def accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                # Raised once the listener is closed, or if a client fails to authenticate
+                if self.stopping.is_set():
+                    return
+                logging.warning('Refused a connection')
+                continue
+            handler = threading.Thread(target=self.handle, args=(conn,), daemon=True)
+            self.handlers.append(handler)
+            handler.start()
+
+    def handle(self, conn):
+        """Answer a worker's messages until it disconnects"""
+        claimed = set()
+        logging.info(f'Worker connected, {len(self.handlers)} so far')
+        try:
+            while True:
+                kind, *args = conn.recv()
+                if kind == 'claim':
+                    job = None if self.stopping.is_set() else self.jobs.claim()
+                    if job is not None:
+                        claimed.add(job[1])
+                        conn.send(('job', *job))
+                    elif self.stopping.is_set():
+                        conn.send(('stop',))
+                    else:
+                        conn.send(('wait', self.WAIT))
+                elif kind == 'done':
+                    s3path, score = args
+                    claimed.discard(s3path)
+                    self.jobs.finish(s3path, score)
+                elif kind == 'failed':
+                    s3path, error = args
+                    claimed.discard(s3path)
+                    self.jobs.fail(s3path, error, self.grader.conf.MAX_ATTEMPTS)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+            for s3path in claimed:
+                self.jobs.requeue(s3path)
+            if claimed:
+                logging.warning(f'Worker disconnected, requeued {len(claimed)} of its jobs')
+
+
+class Worker:
+    """Claims jobs from a coordinator and grades them with a local Grader,
+    WORKERS at a time. Results are uploaded by the worker as usual. It
+    stands in for the job queue of Grader.grade_job, reporting to the coordinator"""
+
+    def __init__(self, grader, address, authkey):
+        self.grader = grader
+        # Workers don't list keys, and saving an index would overwrite the
+        # coordinator's (or another worker's) INDEX_FILE
+        self.grader.index = None
+        self.conn = Client(address, authkey=authkey)
+        self.lock = threading.Lock()
+
+    def request(self, *message):
+        with self.lock:
+            self.conn.send(message)
+            return self.conn.recv()
+
+    def notify(self, *message):
+        with self.lock:
+            self.conn.send(message)
+
+    def finish(self, s3path, score):
+        self.notify('done', s3path, score)
+
+    def fail(self, s3path, error, max_attempts):
+        self.notify('failed', s3path, error)
+
+    def run(self):
+        """Grade jobs until the coordinator says to stop, then wait for
+        the uploads to finish before disconnecting"""
+        try:
+            with ThreadPoolExecutor(max_workers=self.grader.conf.WORKERS) as executor:
+                for _ in range(self.grader.conf.WORKERS):
+                    executor.submit(self.work)
+        finally:
+            try:
+                self.grader.close()
+            finally:
+                self.conn.close()
+
+    def work(self):
+        while True:
+            try:
+                kind, *args = self.request('claim')
+            except (EOFError, OSError):
+                logging.error('Lost connection to the coordinator')
+                return
+            if kind == 'stop':
+                return
+            elif kind == 'wait':
+                time.sleep(args[0])
+            else:
+                # Queued here until prepare_submission starts on it
+                self.grader.metrics.inc('grader_submissions_queued')
+                self.grader.grade_job(self, *args)
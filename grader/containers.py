@@ -0,0 +1,318 @@
+# Standard libs
+import io
+import os
+import time
+import queue
+import shlex
+import asyncio
+import tarfile
+import logging
+import threading
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+# Third party libs
+import docker
+
+
+def parse_cpus(spec):
+    """List the cpus of a cpuset spec like '0-3,6'. If spec is None,
+    every cpu this process may run on is listed"""
+    if spec is None:
+        return sorted(os.sched_getaffinity(0))
+    cpus = []
+    for part in str(spec).split(','):
+        first, _, last = part.strip().partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return sorted(set(cpus))
+
+
+class CpusetAllocator:
+    """Hand out disjoint sets of cpus to concurrent containers, so that each
+    container is pinned to cpus of its own and runs at the same speed however
+    many other containers are running"""
+
+    def __init__(self, cpus, per_container):
+        self.per_container = per_container
+        self.free = list(cpus)
+        self.capacity = len(self.free) // per_container
+        if not self.capacity:
+            raise ValueError(f'Cannot pin containers to {per_container} cpus, only {len(self.free)} available')
+        self.available = threading.Condition()
+
+    def acquire(self):
+        """Wait for enough free cpus and take them, returns a cpuset spec"""
+        with self.available:
+            self.available.wait_for(lambda: len(self.free) >= self.per_container)
+            cpus, self.free = self.free[:self.per_container], self.free[self.per_container:]
+        return ','.join(map(str, cpus))
+
+    def release(self, cpuset):
+        with self.available:
+            self.free = sorted(self.free + parse_cpus(cpuset))
+            self.available.notify()
+
+    @contextmanager
+    def allocate(self):
+        cpuset = self.acquire()
+        try:
+            yield cpuset
+        finally:
+            self.release(cpuset)
+
+
+def allocate_cpus(cpusets):
+    """Context giving a cpuset from an allocator, or None if there is none"""
+    return cpusets.allocate() if cpusets is not None else nullcontext()
+
+
+class ContainerPool:
+    """Pool of pre-started sandbox containers, so that submissions don't wait
+    for a container to be created and started. A code dir is copied into an
+    idle container, the test command is exec'ed in it and results are copied
+    back. Each container runs a single submission: a submission may write
+    anywhere in its container, so it is then removed and a fresh container
+    is started in its place, in the background."""
+
+    # Exit code of coreutils' timeout when the command ran out of time
+    TIMEOUT_EXIT_CODE = 124
+    # Seconds between timeout's TERM and KILL signals
+    KILL_AFTER = 5
+    # Extra seconds docker's client waits for an exec, on top of the test timeout
+    CLIENT_TIMEOUT_MARGIN = 30
+    # Seconds to wait before starting a replacement container again when it failed
+    RETRY_DELAY = 5
+
+    def __init__(self, size, image='grader', cwd='/code', timeout=180, volumes=None,
+                 limits=None, cpusets=None):
+        # exec_run blocks reading the socket until the command exits, so the
+        # client can't give up before timeout kills the command
+        self.client = docker.from_env(timeout=timeout + self.KILL_AFTER + self.CLIENT_TIMEOUT_MARGIN)
+        self.image, self.cwd, self.timeout = image, cwd, timeout
+        self.volumes = volumes or {}
+        self.limits, self.cpusets = limits or {}, cpusets
+        self.pinned = {}
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.closing = threading.Event()
+        self.replacer = ThreadPoolExecutor(max_workers=size)
+        for _ in range(size):
+            self.idle.put(self.start_container())
+
+    def start_container(self):
+        """Start a container that idles until commands are exec'ed in it.
+        It keeps its cpuset, if any, until it is discarded"""
+        cpuset = self.cpusets.acquire() if self.cpusets is not None else None
+        try:
+            container = self.client.containers.run(self.image, 'sleep infinity', detach=True,
+                                                   volumes=self.volumes, working_dir=self.cwd,
+                                                   cpuset_cpus=cpuset, **self.limits)
+        except Exception:
+            if cpuset is not None:
+                self.cpusets.release(cpuset)
+            raise
+        container.exec_run(['mkdir', '-p', self.cwd])
+        with self.lock:
+            self.pinned[container.id] = cpuset
+        logging.debug(f'Started pool container {container.id}')
+        return container
+
+    def discard_container(self, container):
+        """Remove a container from the pool and from docker"""
+        with self.lock:
+            cpuset = self.pinned.pop(container.id, None)
+        try:
+            container.remove(v=True, force=True)
+        except docker.errors.APIError as e:
+            logging.warning(f'Could not remove pool container {container.id}: {e}')
+        if cpuset is not None:
+            self.cpusets.release(cpuset)
+
+    def run(self, code_dir, cmd, result_file, stats=None):
+        """Run cmd with code_dir as working directory in a pooled container,
+        killing it after the pool's timeout.
+        The result_file is copied back to code_dir if it was created.
+        Returns the raw logs and whether the command timed out. The time taken
+        to copy code_dir and to run cmd, and the exit code are put in stats"""
+        stats = {} if stats is None else stats
+        container = self.idle.get()
+        try:
+            logging.info(f'CONTAINER {container.id}')
+            t0 = time.time()
+            container.put_archive(self.cwd, self.archive(code_dir))
+            t1 = time.time()
+            cmd = ['timeout', '-k', str(self.KILL_AFTER), str(self.timeout)] + shlex.split(cmd)
+            exit_code, logs = container.exec_run(cmd, workdir=self.cwd)
+            stats.update(container_start=t1 - t0, test_run=time.time() - t1, exit_code=exit_code)
+            self.copy_result(container, code_dir, result_file)
+        finally:
+            # Never reused, even if the run failed part way
+            self.replacer.submit(self.replace, container)
+        return logs, exit_code == self.TIMEOUT_EXIT_CODE
+
+    def copy_result(self, container, code_dir, result_file):
+        """Copy result_file from the container back into code_dir"""
+        try:
+            stream, _ = container.get_archive(f'{self.cwd}/{result_file}')
+        except docker.errors.NotFound:
+            return
+        with tarfile.open(fileobj=io.BytesIO(b''.join(stream))) as tar:
+            tar.extractall(code_dir)
+
+    def replace(self, container):
+        """Remove a used container and put a fresh one in the pool. Starting
+        it is retried until it works or the pool is closed"""
+        self.discard_container(container)
+        while not self.closing.is_set():
+            try:
+                self.idle.put(self.start_container())
+                return
+            except Exception:
+                logging.exception(f'Could not start a pool container, retrying in {self.RETRY_DELAY}s')
+                self.closing.wait(self.RETRY_DELAY)
+
+    @staticmethod
+    def archive(code_dir):
+        """Tar the contents of code_dir in memory for docker's put_archive"""
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w') as tar:
+            tar.add(code_dir, arcname='.')
+        return data.getvalue()
+
+    def close(self):
+        """Remove every container in the pool, once replacements are started"""
+        self.closing.set()
+        self.replacer.shutdown(wait=True)
+        while not self.idle.empty():
+            self.discard_container(self.idle.get())
+
+
+class ContainerEventRunner:
+    """Run many containers concurrently and react to their exit events from a
+    single docker event stream, instead of blocking one thread per container
+    on container.wait. Each container gets its own timeout deadline."""
+
+    def __init__(self, image='grader', cwd='/code', timeout=180, max_containers=8, volumes=None,
+                 limits=None, cpusets=None):
+        self.client = docker.from_env()
+        self.image, self.cwd, self.timeout = image, cwd, timeout
+        self.volumes = volumes or {}
+        self.limits, self.cpusets = limits or {}, cpusets
+        self.max_containers = max_containers
+        self.exits = {}
+
+    def run(self, jobs, on_done, prefetch=1):
+        """Run every job, a (key, code_dir, cmd) tuple, in its own container
+        with code_dir mounted as working directory. jobs can be a generator
+        that prepares them: it is consumed from a worker thread, at most prefetch
+        jobs ahead of the containers that can be started. As each container
+        finishes, on_done(key, logs, timed_out, latency, stats) is called from a
+        worker thread, stats has the time taken to start the container and run it,
+        and its exit code. If a container couldn't be run, on_done gets logs=None
+        and the error in stats['error']. Returns the values returned by on_done, in
+        the order of jobs (None for jobs whose on_done raised)"""
+        return asyncio.run(self.run_all(jobs, on_done, prefetch))
+
+    async def run_all(self, jobs, on_done, prefetch):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.max_containers)
+        ready, end = asyncio.Queue(maxsize=max(1, prefetch)), object()
+
+        async def feed():
+            try:
+                jobs_iter = iter(jobs)
+                while True:
+                    job = await loop.run_in_executor(None, next, jobs_iter, end)
+                    if job is end:
+                        break
+                    await ready.put(job)
+            except Exception:
+                logging.exception('Failed to prepare the next jobs')
+            finally:
+                await ready.put(end)
+
+        # Subscribe to exit events before any container is started
+        events = docker.from_env().events(decode=True, filters={'type': 'container', 'event': 'die'})
+        watcher = threading.Thread(target=self.watch_events, args=(events, loop), daemon=True)
+        watcher.start()
+        feeder = asyncio.ensure_future(feed())
+        keys, tasks = [], []
+        try:
+            while True:
+                # Only take a job once a container can be started for it
+                await slots.acquire()
+                job = await ready.get()
+                if job is end:
+                    slots.release()
+                    break
+                keys.append(job[0])
+                tasks.append(asyncio.ensure_future(self.run_job(job, on_done, slots)))
+            await feeder
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            events.close()
+        for key, result in zip(keys, results):
+            if isinstance(result, Exception):
+                logging.error(f'Failed to handle the container of {key}: {result!r}')
+        return [None if isinstance(result, Exception) else result for result in results]
+
+    def watch_events(self, events, loop):
+        """Forward container exit events to the event loop"""
+        try:
+            for event in events:
+                exit_code = int(event['Actor']['Attributes'].get('exitCode', -1))
+                loop.call_soon_threadsafe(self.on_exit, event['id'], exit_code)
+        except Exception:
+            # Raised when the stream is closed once every job is done
+            pass
+
+    def on_exit(self, container_id, exit_code):
+        exited = self.exits.get(container_id)
+        if exited is not None and not exited.done():
+            exited.set_result(exit_code)
+
+    async def run_job(self, job, on_done, slots):
+        """Run a job's container, which is removed whatever happens. The slot
+        taken for it in slots is released once it is removed"""
+        loop = asyncio.get_running_loop()
+        key, code_dir, cmd = job
+        logs, timed_out, stats = None, False, {}
+        t0 = time.time()
+        try:
+            # max_containers is at most the allocator's capacity, so this doesn't block
+            with allocate_cpus(self.cpusets) as cpuset:
+                container = None
+                try:
+                    volumes = {os.path.abspath(code_dir): {'bind': self.cwd, 'mode': 'rw'}, **self.volumes}
+                    container = await loop.run_in_executor(None, lambda: self.client.containers.create(
+                        self.image, cmd, volumes=volumes, working_dir=self.cwd, cpuset_cpus=cpuset, **self.limits))
+                    self.exits[container.id] = loop.create_future()
+                    t0 = time.time()
+                    await loop.run_in_executor(None, container.start)
+                    stats['container_start'] = time.time() - t0
+                    try:
+                        stats['exit_code'] = await asyncio.wait_for(asyncio.shield(self.exits[container.id]),
+                                                                    self.timeout)
+                    except asyncio.TimeoutError:
+                        await loop.run_in_executor(None, container.stop)
+                        timed_out = True
+                    stats['test_run'] = time.time() - t0 - stats['container_start']
+                    logs = await loop.run_in_executor(None, container.logs)
+                except Exception as e:
+                    logs, stats['error'] = None, repr(e)
+                finally:
+                    if container is not None:
+                        self.exits.pop(container.id, None)
+                        await loop.run_in_executor(None, self.remove_container, container)
+        finally:
+            slots.release()
+        latency = time.time() - t0
+        return await loop.run_in_executor(None, on_done, key, logs, timed_out, latency, stats)
+
+    @staticmethod
+    def remove_container(container):
+        """Stop and remove a container, which may still be running"""
+        try:
+            container.remove(v=True, force=True)
+        except docker.errors.APIError as e:
+            logging.warning(f'Could not remove container {container.id}: {e}')
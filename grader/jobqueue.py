@@ -0,0 +1,103 @@
+# Standard libs
+import time
+import sqlite3
+import threading
+
+
+class JobQueue:
+    """Durable queue of submissions to grade, kept in a sqlite database.
+    Every change is committed right away, so after a crash or a restart
+    jobs that were running are picked up again and finished jobs are not
+    regraded. Jobs are claimed by priority: lowest rank first, then newest
+    submission date first, then in the order they were added.
+
+    A job is in one of the states:
+        pending: waiting to be graded
+        running: claimed by a worker
+        done: graded and its result uploaded (or spooled)
+        failed: grading failed max_attempts times"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                        'key TEXT PRIMARY KEY, project TEXT NOT NULL, state TEXT NOT NULL, '
+                        'attempts INTEGER NOT NULL DEFAULT 0, score REAL, error TEXT, updated REAL)')
+        # Queues made before jobs had a priority get the columns added
+        columns = {row[1] for row in self.db.execute('PRAGMA table_info(jobs)')}
+        if 'rank' not in columns:
+            self.db.execute('ALTER TABLE jobs ADD COLUMN rank INTEGER NOT NULL DEFAULT 1')
+            self.db.execute('ALTER TABLE jobs ADD COLUMN submitted REAL NOT NULL DEFAULT 0')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_priority ON jobs (state, rank, submitted)')
+
+    def add(self, project, priorities):
+        """Queue the keys of priorities, a dict of key to (rank, submission date
+        timestamp), that aren't in the queue yet. The priority of pending jobs
+        already in the queue is updated. Returns how many keys were added"""
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.executemany("UPDATE jobs SET rank = ?, submitted = ? WHERE key = ? AND state = 'pending'",
+                                [(rank, submitted, key) for key, (rank, submitted) in priorities.items()])
+            before = self.db.total_changes
+            self.db.executemany("INSERT OR IGNORE INTO jobs (key, project, state, updated, rank, submitted) "
+                                "VALUES (?, ?, 'pending', ?, ?, ?)",
+                                [(key, project, now, rank, submitted) for key, (rank, submitted) in priorities.items()])
+            added = self.db.total_changes - before
+            self.db.execute('COMMIT')
+            return added
+
+    def claim(self):
+        """Mark the pending job with the highest priority as running and
+        return its (project, key), or None if there is nothing to do"""
+        with self.lock:
+            row = self.db.execute("SELECT project, key FROM jobs WHERE state = 'pending' "
+                                  "ORDER BY rank, submitted DESC, rowid LIMIT 1").fetchone()
+            if row is not None:
+                self.db.execute("UPDATE jobs SET state = 'running', attempts = attempts + 1, updated = ? "
+                                "WHERE key = ?", (time.time(), row[1]))
+            return row
+
+    def finish(self, key, score):
+        with self.lock:
+            self.db.execute("UPDATE jobs SET state = 'done', score = ?, error = NULL, updated = ? "
+                            "WHERE key = ?", (score, time.time(), key))
+
+    def fail(self, key, error, max_attempts):
+        """Put a job back in the queue, unless it failed max_attempts times.
+        Returns whether it was put back"""
+        with self.lock:
+            self.db.execute("UPDATE jobs SET error = ?, updated = ?, state = "
+                            "CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END "
+                            "WHERE key = ?", (error, time.time(), max_attempts, key))
+            row = self.db.execute('SELECT state FROM jobs WHERE key = ?', (key,)).fetchone()
+            return row is not None and row[0] == 'pending'
+
+    def requeue(self, key):
+        """Put a running job back in the queue without counting it as an attempt"""
+        with self.lock:
+            self.db.execute("UPDATE jobs SET state = 'pending', attempts = attempts - 1, updated = ? "
+                            "WHERE key = ? AND state = 'running'", (time.time(), key))
+
+    def recover(self):
+        """Requeue the jobs that were running when the queue was last closed,
+        returns the number of pending jobs"""
+        with self.lock:
+            self.db.execute("UPDATE jobs SET state = 'pending' WHERE state = 'running'")
+        return self.counts().get('pending', 0)
+
+    def unfinished(self):
+        """Whether any job is pending or running"""
+        counts = self.counts()
+        return counts.get('pending', 0) + counts.get('running', 0) > 0
+
+    def counts(self):
+        """Number of jobs in each state"""
+        with self.lock:
+            return dict(self.db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def close(self):
+        with self.lock:
+            self.db.close()
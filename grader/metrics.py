@@ -0,0 +1,96 @@
+# Standard libs
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Metrics:
+    """Thread-safe registry of counters, gauges and histograms that can be
+    served over http in Prometheus' text format, to follow long runs live"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, name, kind, help_text, **extra):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = dict(kind=kind, help=help_text, value=0, **extra)
+
+    def counter(self, name, help_text):
+        self.register(name, 'counter', help_text)
+
+    def gauge(self, name, help_text, fn=None):
+        """Register a gauge, if fn is given it is called to get the value"""
+        self.register(name, 'gauge', help_text, fn=fn)
+
+    def histogram(self, name, help_text, buckets):
+        self.register(name, 'histogram', help_text, buckets=sorted(buckets),
+                      counts=[0] * len(buckets), sum=0)
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.metrics[name]['value'] += value
+
+    def dec(self, name, value=1):
+        self.inc(name, -value)
+
+    def value(self, name):
+        with self.lock:
+            return self.metrics[name]['value']
+
+    def observe(self, name, value):
+        with self.lock:
+            metric = self.metrics[name]
+            metric['value'] += 1
+            metric['sum'] += value
+            index = bisect.bisect_left(metric['buckets'], value)
+            if index < len(metric['buckets']):
+                metric['counts'][index] += 1
+
+    def render(self):
+        """Text exposition of every metric"""
+        lines = []
+        with self.lock:
+            metrics = {name: dict(metric) for name, metric in self.metrics.items()}
+        for name, metric in metrics.items():
+            lines.append(f'# HELP {name} {metric["help"]}')
+            lines.append(f'# TYPE {name} {metric["kind"]}')
+            if metric['kind'] == 'histogram':
+                cumulative = 0
+                for bucket, count in zip(metric['buckets'], metric['counts']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{le="{bucket:g}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{le="+Inf"}} {metric["value"]}')
+                lines.append(f'{name}_sum {metric["sum"]:g}')
+                lines.append(f'{name}_count {metric["value"]}')
+            else:
+                value = metric['fn']() if metric.get('fn') else metric['value']
+                lines.append(f'{name} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve the metrics on http://host:port/metrics from a daemon thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') not in ('', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f'Serving metrics on http://{host}:{port}/metrics')
+        return server
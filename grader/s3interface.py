@@ -3,26 +3,331 @@ import os
 import re
 import json
 import copy
+import codecs
+import time
+import queue
 import base64
+import random
 import shutil
 import string
+import hashlib
 import logging
 import argparse
-from datetime import datetime
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 
 # Third party libs
 import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 from tqdm import tqdm
 from easydict import EasyDict as edict
 
+# Local imports
+from metrics import Metrics
+
+
+class SubmissionStream:
+    """Incremental parser of a submission's json. The base64 `payload` is decoded
+    chunk by chunk straight into a file while it is read, so memory use stays
+    bounded no matter how large the submission is. The submission is expected
+    to be a json object, its other fields are small and parsed as usual"""
+    special_chars = re.compile(r'["\\]')
+    # Characters b64decode ignores, such as whitespace
+    not_base64 = re.compile(r'[^A-Za-z0-9+/=]')
+    # Characters that can follow a complete json value
+    delimiters = set(' \t\r\n,:]}')
+    escapes = {'"': '"', '\\': '\\', '/': '/', 'b': '', 'f': '', 'n': '', 'r': '', 't': ''}
+
+    def __init__(self, body, chunk_size=2**16):
+        self.body, self.chunk_size = body, chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer, self.pos, self.eof = '', 0, False
+
+    def fill(self):
+        """Read the next chunk into the buffer, dropping what was consumed.
+        Returns False if there was nothing left to read"""
+        if self.eof:
+            return False
+        chunk = self.body.read(self.chunk_size)
+        self.eof = not chunk
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(chunk, final=self.eof)
+        self.pos = 0
+        return not self.eof
+
+    def peek(self):
+        """Skip whitespace and return the next character, '' at the end"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f'Expected {char!r} at {self.buffer[self.pos:self.pos + 20]!r}')
+        self.pos += 1
+
+    def value(self):
+        """Parse a regular json value"""
+        self.peek()
+        while True:
+            try:
+                value, end = json.JSONDecoder().raw_decode(self.buffer, self.pos)
+                # A number cut by the end of the buffer, like 1.5 of 1.5e10, is
+                # only complete if a delimiter follows it
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in self.delimiters):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def payload(self, out):
+        """Decode the base64 json string at the current position into out"""
+        self.expect('"')
+        pending = ''
+        while True:
+            match = self.special_chars.search(self.buffer, self.pos)
+            end = match.start() if match else len(self.buffer)
+            pending += self.not_base64.sub('', self.buffer[self.pos:end])
+            self.pos = end
+            # Base64 is decoded in groups of 4 characters
+            usable = len(pending) - len(pending) % 4
+            out.write(base64.b64decode(pending[:usable]))
+            pending = pending[usable:]
+            if match is None:
+                if not self.fill():
+                    raise ValueError('Unterminated payload')
+            elif self.buffer[self.pos] == '"':
+                self.pos += 1
+                break
+            else:
+                while len(self.buffer) - self.pos < 6 and self.fill():
+                    pass
+                escaped = self.buffer[self.pos + 1]
+                if escaped == 'u':
+                    pending += self.not_base64.sub('', chr(int(self.buffer[self.pos + 2:self.pos + 6], 16)))
+                    self.pos += 6
+                else:
+                    pending += self.escapes[escaped]
+                    self.pos += 2
+        out.write(base64.b64decode(pending))
+
+    def parse(self, out):
+        """Parse the whole submission, the decoded payload is written to out
+        and the other fields are returned"""
+        fields = {}
+        self.expect('{')
+        while self.peek() != '}':
+            key = self.value()
+            self.expect(':')
+            if key == 'payload':
+                self.peek()
+                self.payload(out)
+            else:
+                fields[key] = self.value()
+            if self.peek() == ',':
+                self.pos += 1
+        self.expect('}')
+        return fields
+
+
+class KeyIndex:
+    """Persistent local index of the s3 keys seen so far, along with their
+    size, last modified date and ETag. The score of result keys is cached in it.
+    It can also make listings incremental, as only the keys after the last
+    known one of a prefix need to be listed"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.keys = json.load(f)
+        except FileNotFoundError:
+            self.keys = {}
+
+    def add(self, key, size, modified, etag, score=None):
+        with self.lock:
+            self.keys[key] = {'size': size, 'modified': modified.isoformat(), 'etag': etag}
+            if score is not None:
+                self.keys[key]['score'] = score
+
+    def sync(self, prefix, items):
+        """Replace the keys under prefix by the listed items. Cached scores
+        are kept for keys whose size and ETag didn't change. The last modified
+        date isn't compared, as the one of an upload is only known from a listing"""
+        with self.lock:
+            old = {key: self.keys.pop(key) for key in list(self.keys) if key.startswith(prefix)}
+            for item in items:
+                entry = {'size': item['Size'], 'modified': item['LastModified'].isoformat(),
+                         'etag': item['ETag']}
+                previous = old.get(item['Key'], {})
+                if 'score' in previous and all(previous.get(field) == entry[field]
+                                               for field in ('size', 'etag')):
+                    entry['score'] = previous['score']
+                self.keys[item['Key']] = entry
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def get_score(self, key):
+        return self.keys.get(key, {}).get('score')
+
+    def set_score(self, key, score):
+        with self.lock:
+            if key in self.keys:
+                self.keys[key]['score'] = score
+
+    def under(self, prefix):
+        """Known keys that start with prefix"""
+        with self.lock:
+            return [key for key in self.keys if key.startswith(prefix)]
+
+    def save(self):
+        with self.lock:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                            prefix=os.path.basename(self.path), suffix='.tmp')
+            try:
+                with open(fd, 'w', encoding='utf-8') as f:
+                    json.dump(self.keys, f)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+
+class LocalS3Client:
+    """Stand-in for the boto3 s3 client that keeps objects as files under
+    root/bucket/key, so the grader and downloader can be run and benchmarked
+    offline. Only the calls and fields Database uses are implemented. An
+    optional latency, in seconds, is added to every request to mimic a
+    round trip to s3"""
+
+    class exceptions:
+        class NoSuchKey(ClientError):
+            def __init__(self, key):
+                super().__init__({'Error': {'Code': 'NoSuchKey', 'Message': f'No such key: {key}'}}, 'GetObject')
+
+    # Max number of keys in a page of a listing, as for s3
+    PAGE_SIZE = 1000
+
+    def __init__(self, root, latency=0):
+        self.root, self.latency = root, latency
+        self.etags = {}
+        os.makedirs(os.path.join(root, '.uploads'), exist_ok=True)
+
+    def path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def request(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def head(self, path, key):
+        """Listing entry of the object at path. ETags are MD5s, as for objects
+        that weren't multipart uploads, and cached until the file changes"""
+        stat = os.stat(path)
+        version = (path, stat.st_size, stat.st_mtime_ns)
+        if version not in self.etags:
+            with open(path, 'rb') as f:
+                md5 = hashlib.md5()
+                for chunk in iter(lambda: f.read(2**20), b''):
+                    md5.update(chunk)
+            self.etags[version] = f'"{md5.hexdigest()}"'
+        return {'Key': key, 'Size': stat.st_size, 'ETag': self.etags[version],
+                'LastModified': datetime.fromtimestamp(stat.st_mtime, timezone.utc)}
+
+    def get_object(self, Bucket, Key):
+        self.request()
+        path = self.path(Bucket, Key)
+        try:
+            body = open(path, 'rb')
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            raise self.exceptions.NoSuchKey(Key)
+        head = self.head(path, Key)
+        return {'Body': body, 'ContentLength': head['Size'], 'ETag': head['ETag'],
+                'LastModified': head['LastModified']}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.request()
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, '.uploads'))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(Body.encode('utf-8') if type(Body) is str else Body)
+        os.replace(tmp_path, path)
+        return {'ETag': self.head(path, Key)['ETag']}
+
+    def get_paginator(self, operation):
+        if operation != 'list_objects_v2':
+            raise NotImplementedError(operation)
+        return self
+
+    def keys(self, bucket, prefix):
+        """Every key starting with prefix, in s3's order"""
+        bucket_dir = os.path.join(self.root, bucket)
+        # Only walk the deepest directory that contains the whole prefix
+        top = os.path.join(bucket_dir, *prefix.split('/')[:-1])
+        keys = []
+        for root, dirs, files in os.walk(top):
+            rel_dir = os.path.relpath(root, bucket_dir).replace(os.sep, '/')
+            for name in files:
+                key = name if rel_dir == '.' else f'{rel_dir}/{name}'
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys, key=lambda k: k.encode('utf-8'))
+
+    def paginate(self, Bucket, Prefix='', StartAfter=None, Delimiter=None):
+        """Yield pages of a list_objects_v2 listing"""
+        keys = self.keys(Bucket, Prefix)
+        if StartAfter:
+            keys = [key for key in keys if key.encode('utf-8') > StartAfter.encode('utf-8')]
+        entries, prefixes = [], []
+        for key in keys:
+            if Delimiter and Delimiter in key[len(Prefix):]:
+                common_prefix = key[:key.index(Delimiter, len(Prefix)) + len(Delimiter)]
+                if not prefixes or prefixes[-1][1] != common_prefix:
+                    prefixes.append((key, common_prefix))
+            else:
+                entries.append((key, None))
+        # Objects and common prefixes share the pages, in key order
+        listing = sorted(entries + prefixes, key=lambda item: item[0].encode('utf-8'))
+        for start in range(0, max(len(listing), 1), self.PAGE_SIZE):
+            self.request()
+            page = {'Contents': [], 'CommonPrefixes': []}
+            for key, common_prefix in listing[start:start + self.PAGE_SIZE]:
+                if common_prefix is None:
+                    page['Contents'].append(self.head(self.path(Bucket, key), key))
+                else:
+                    page['CommonPrefixes'].append({'Prefix': common_prefix})
+            yield page
+
 
 class Database:
     def __init__(self, config_path=None, **kwargs):
         self.conf = self.read_conf(config_path)
         self.conf = self.override_defaults(self.conf, **kwargs)
-        self.session = boto3.Session(profile_name=self.conf.PROFILE)
-        self.s3 = self.session.client(self.conf.SESSION_CLIENT)
+        if self.conf.BACKEND == 'local':
+            self.s3 = LocalS3Client(self.conf.LOCAL_ROOT, latency=self.conf.LOCAL_LATENCY)
+        else:
+            self.session = boto3.Session(profile_name=self.conf.PROFILE)
+            # The client is shared by all threads, give it enough connections for each
+            pool_size = max(10, self.conf.DOWNLOAD_WORKERS)
+            self.s3 = self.session.client(self.conf.SESSION_CLIENT, config=Config(max_pool_connections=pool_size))
         self.safe_s3_chars = set(string.ascii_letters + string.digits + ".-_")
+        if self.conf.INDEX_FILE and self.conf.REINDEX and os.path.exists(self.conf.INDEX_FILE):
+            os.remove(self.conf.INDEX_FILE)
+        self.index = KeyIndex(self.conf.INDEX_FILE) if self.conf.INDEX_FILE else None
+        self.uploads = None
+        self.uploads_lock = threading.Lock()
+        self.metrics = Metrics()
+        self.metrics.counter('s3_downloaded_bytes_total', 'Bytes downloaded from s3')
+        self.metrics.counter('s3_uploaded_bytes_total', 'Bytes uploaded to s3')
 
     @staticmethod
     def read_conf(config_path):
@@ -51,7 +356,12 @@ class Database:
         file_info.date = datetime.strptime(date, "%Y-%m-%d_%H-%M-%S")
         return file_info
 
-    def get_submissions(self, project, rerun, email=None):
+    def get_submissions(self, project, rerun, email=None, latest_only=False, with_priorities=False):
+        """Keys of the submissions of a project, or only of the student with the
+        given email. Unless rerun, submissions with results are left out. If
+        latest_only, submissions superseded by a newer one of the same student are too.
+        If with_priorities, returns a dict of their priorities instead, ranked
+        among all the submissions, with results or not"""
         prefix = self.conf.PREFIX + project + '/'
         if email:
             if '@' not in email:
@@ -59,62 +369,363 @@ class Database:
             prefix += self.to_s3_key_str(email) + '/'
         submitted = set()
         tested = set()
-        for path in self.s3_all_keys(prefix):
+        if self.index is not None:
+            self.update_index(prefix, shard=not email)
+            paths = self.index.under(prefix)
+        else:
+            paths = self.s3_all_keys(prefix)
+        for path in paths:
             parts = path.split('/')
             if parts[-1] == 'submission.json':
                 submitted.add(path)
             elif parts[-1] == 'test.json':
                 parts[-1] = 'submission.json'
                 tested.add('/'.join(parts))
+        latest = self.latest_submissions(submitted)
+        if with_priorities:
+            priorities = self.priorities(submitted, latest)
+        if latest_only:
+            submitted = latest
         if not rerun:
             submitted -= tested
+        if with_priorities:
+            return {s3path: priorities[s3path] for s3path in submitted}
         return submitted
 
+    def latest_submissions(self, s3paths):
+        """The latest of the submissions of each student to each project.
+        Keys that can't be parsed are kept"""
+        latest, unparsed = {}, set()
+        for s3path in s3paths:
+            try:
+                info = self.parse_s3path(s3path)
+            except ValueError:
+                unparsed.add(s3path)
+                continue
+            student = (info.project_id, info.netid, info.domain)
+            if student not in latest or info.date > latest[student][0]:
+                latest[student] = (info.date, s3path)
+        return {s3path for _, s3path in latest.values()} | unparsed
+
+    def priorities(self, s3paths, latest=None):
+        """Priority of each submission, as a dict of (rank, date) tuples. The rank
+        is 0 for the latest submission of each student (in latest if given), 1 for
+        older submissions and 2 for keys that can't be parsed. The date is a
+        timestamp, 0 if unknown"""
+        if latest is None:
+            latest = self.latest_submissions(s3paths)
+        priorities = {}
+        for s3path in s3paths:
+            try:
+                date = self.parse_s3path(s3path).date
+            except ValueError:
+                priorities[s3path] = (2, 0)
+                continue
+            priorities[s3path] = (0 if s3path in latest else 1), date.timestamp()
+        return priorities
+
+    def prioritize(self, priorities):
+        """Order submissions by their priorities: the latest submission of each
+        student first, newest first, then older submissions, newest first. Keys
+        that can't be parsed come last"""
+        return sorted(priorities, key=lambda s3path: (priorities[s3path][0], -priorities[s3path][1], s3path))
+
+    def update_index(self, prefix, shard=True):
+        """Bring the keys under prefix in the index up to date. Unless
+        LIST_NEW_KEYS_ONLY, prefix is listed in full (concurrently, over shards).
+        Otherwise only keys that aren't known yet are listed: if shard, the prefix
+        is split into per student prefixes and each is listed from its last known
+        key on, as a student's new submissions sort after their old ones. Keys written
+        by someone else that sort before the last known key are then missed"""
+        known = self.index.under(prefix)
+        if not self.conf.LIST_NEW_KEYS_ONLY:
+            self.index.sync(prefix, self.s3_all_objects(prefix))
+            self.index.save()
+            return
+        if shard and known:
+            last_keys = {}
+            for key in known:
+                sub_prefix = key[:key.find('/', len(prefix)) + 1]
+                last_keys[sub_prefix] = max(last_keys.get(sub_prefix, ''), key)
+            prefixes, items = self.s3_list_level(prefix)
+            items += self.s3_objects_concurrently(prefixes, start_after=last_keys)
+        elif known:
+            items = self.s3_list_objects(prefix, start_after=max(known))
+        else:
+            items = self.s3_all_objects(prefix)
+        for item in items:
+            self.index.add(item['Key'], item['Size'], item['LastModified'], item['ETag'])
+        self.index.save()
+
     def fetch_submission(self, s3path, filename=None, directory=None):
         # Get submission from s3
         response = self.s3.get_object(Bucket=self.conf.BUCKET, Key=s3path)
-        submission = json.loads(response['Body'].read().decode('utf-8'))
-        file_contents = base64.b64decode(submission.pop('payload'))
-        # Resolve path of file
+        self.metrics.inc('s3_downloaded_bytes_total', response['ContentLength'])
+        # Resolve directory of file
+        shared_directory = directory is not None
         if directory is None:
             directory = os.path.join(self.conf.S3_DIR, os.path.dirname(s3path))
-        filename = filename if filename else submission['filename']
-        file_path = os.path.join(directory, filename)
-        # Create directory, remove if submission is present
-        if os.path.exists(file_path):
-            shutil.rmtree(directory)
-        os.makedirs(directory, exist_ok=True)
-        # Write file contents to disk
-        with open(file_path, 'wb') as f:
-            f.write(file_contents)
+        # Decode payload to a temporary file, as the filename is only
+        # known once the whole submission is parsed
+        tmp_dir = directory if shared_directory else os.path.dirname(os.path.normpath(directory))
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, prefix='.payload-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                submission = SubmissionStream(response['Body']).parse(f)
+            filename = filename if filename else submission['filename']
+            file_path = os.path.join(directory, filename)
+            # Create directory, remove if submission is present. Only done for
+            # per submission directories as a given directory can be shared
+            if not shared_directory and os.path.exists(file_path):
+                shutil.rmtree(directory)
+            os.makedirs(directory, exist_ok=True)
+            os.replace(tmp_path, file_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
         return directory, filename
 
+    def prefetch_submissions(self, s3paths, filename=None, directory=None, depth=None):
+        """Fetch submissions ahead of time from a pool of threads while earlier
+        ones are being used. Yields (s3path, future) in order, where the future
+        resolves to what fetch_submission returns. At most `depth` submissions
+        are fetched ahead of the one being used. It's up to the caller to
+        remove what it is done with (the grader does with CLEANUP)"""
+        depth = depth or self.conf.PREFETCH
+        s3paths = iter(s3paths)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=depth) as executor:
+            def submit_next():
+                s3path = next(s3paths, None)
+                if s3path is not None:
+                    future = executor.submit(self.fetch_submission, s3path, filename=filename, directory=directory)
+                    pending.append((s3path, future))
+            try:
+                for _ in range(depth):
+                    submit_next()
+                while pending:
+                    s3path, future = pending.popleft()
+                    submit_next()
+                    yield s3path, future
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
     def fetch_results(self, s3path):
         s3path = s3path.replace('submission.json', 'test.json')
-        response = self.s3.get_object(Bucket=self.conf.BUCKET, Key=s3path)
         try:
+            response = self.s3.get_object(Bucket=self.conf.BUCKET, Key=s3path)
+            self.metrics.inc('s3_downloaded_bytes_total', response['ContentLength'])
             submission = json.loads(response['Body'].read().decode('utf-8'))
             logging.debug(f'Previous submission found for {s3path}')
+            if self.index is not None:
+                self.index.set_score(s3path, submission['score'])
             return submission['score']
         except self.s3.exceptions.NoSuchKey:
             logging.debug(f'No previous submission found for {s3path}')
             return 0
 
+    def fetch_all_results(self, s3paths):
+        """Scores of the previous results of many submissions, as a dict.
+        Scores cached in the key index are reused, the others are fetched
+        concurrently. Submissions without results are given a score of 0. A
+        result missing from the index is fetched too, it may have been written
+        since the index was updated"""
+        scores, to_fetch = {}, []
+        for s3path in s3paths:
+            key = s3path.replace('submission.json', 'test.json')
+            if self.index is not None and self.index.get_score(key) is not None:
+                scores[s3path] = self.index.get_score(key)
+            else:
+                to_fetch.append(s3path)
+        logging.info(f'Fetching {len(to_fetch)} previous results, {len(scores)} known already')
+        with ThreadPoolExecutor(max_workers=self.conf.DOWNLOAD_WORKERS) as executor:
+            for s3path, score in zip(to_fetch, executor.map(lambda p: self.retry(self.fetch_results, p), to_fetch)):
+                scores[s3path] = score
+        return scores
+
     def put_submission(self, key, submission):
+        score = submission.get('score') if type(submission) is dict else None
         if type(submission) is not str:
             submission = json.dumps(submission, indent=2)
-        self.s3.put_object(Bucket=self.conf.BUCKET, Key=key,
-                           Body=submission.encode('utf-8'),
-                           ContentType='text/plain')
+        body = submission.encode('utf-8')
+        response = self.s3.put_object(Bucket=self.conf.BUCKET, Key=key,
+                                      Body=body, ContentType='text/plain')
+        self.metrics.inc('s3_uploaded_bytes_total', len(body))
+        if self.index is not None:
+            self.index.add(key, len(body), datetime.now(timezone.utc), response['ETag'], score=score)
+
+    def put_submission_later(self, key, submission):
+        """Queue a put_submission to be done by a background thread. If the upload
+        fails it is written to SPOOL_DIR to be retried by upload_spooled.
+        Returns a future of what upload_or_spool returns"""
+        with self.uploads_lock:
+            if self.uploads is None:
+                self.uploads = ThreadPoolExecutor(max_workers=self.conf.UPLOAD_WORKERS)
+            return self.uploads.submit(self.upload_or_spool, key, submission)
+
+    def upload_or_spool(self, key, submission):
+        """Upload or spool a submission, returns the time the upload
+        took or None if it failed"""
+        spool_path = os.path.join(self.conf.SPOOL_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+        t0 = time.time()
+        try:
+            self.retry(self.put_submission, key, submission)
+        except Exception as e:
+            logging.error(f'Failed to upload {key}, spooled it to {spool_path}: {e}')
+            os.makedirs(self.conf.SPOOL_DIR, exist_ok=True)
+            if type(submission) is not str:
+                submission = json.dumps(submission, indent=2)
+            with open(spool_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'key': key, 'submission': submission}, f)
+            os.replace(spool_path + '.tmp', spool_path)
+            return None
+        elapsed = time.time() - t0
+        # An older result for the same key must not be retried over this one
+        if os.path.exists(spool_path):
+            os.remove(spool_path)
+        return elapsed
+
+    def flush_uploads(self):
+        """Wait for every queued upload to be done"""
+        with self.uploads_lock:
+            uploads, self.uploads = self.uploads, None
+        if uploads is not None:
+            uploads.shutdown(wait=True)
+
+    def upload_spooled(self):
+        """Retry the uploads that failed during previous runs"""
+        if not os.path.isdir(self.conf.SPOOL_DIR):
+            return
+        for name in os.listdir(self.conf.SPOOL_DIR):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(self.conf.SPOOL_DIR, name), 'r', encoding='utf-8') as f:
+                spooled = json.load(f)
+            logging.info(f'Retrying spooled upload of {spooled["key"]}')
+            self.put_submission_later(spooled['key'], spooled['submission'])
+        self.flush_uploads()
 
     def s3_all_keys(self, prefix):
-        paginator = self.s3.get_paginator('list_objects')
+        for item in self.s3_all_objects(prefix):
+            yield item['Key']
+
+    def s3_all_objects(self, prefix):
+        """Yield the listing entry (Key, Size, ETag...) of every object under prefix.
+        The prefix is split into shards which are listed concurrently"""
+        prefixes, items = self.s3_shards(prefix)
+        yield from items
+        yield from self.s3_objects_concurrently(prefixes)
+
+    def s3_list_objects(self, prefix, start_after=None):
+        """Yield the listing entry of every object under prefix, optionally
+        only those after the key start_after"""
+        paginator = self.s3.get_paginator('list_objects_v2')
         operation_parameters = {'Bucket': self.conf.BUCKET,
                                 'Prefix': prefix}
+        if start_after:
+            operation_parameters['StartAfter'] = start_after
         page_iterator = paginator.paginate(**operation_parameters)
         for page in page_iterator:
             logging.info('...list_objects...')
-            yield from [item['Key'] for item in page['Contents']]
+            yield from page.get('Contents', [])
+
+    def s3_list_level(self, prefix):
+        """List a single 'directory' level under prefix. Returns the prefixes
+        of its sub-directories and the objects directly in it"""
+        prefixes, items = [], []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        page_iterator = paginator.paginate(Bucket=self.conf.BUCKET, Prefix=prefix, Delimiter='/')
+        for page in page_iterator:
+            logging.info('...list_objects...')
+            prefixes += [item['Prefix'] for item in page.get('CommonPrefixes', [])]
+            items += page.get('Contents', [])
+        return prefixes, items
+
+    def s3_shards(self, prefix):
+        """Split prefix into sub-prefixes that can be listed independently,
+        such as one per student for a project prefix. Prefixes are split one
+        level at a time until there are at least LIST_WORKERS of them, or
+        SHARD_DEPTH levels were split. Returns the shards and the objects found
+        while splitting, which don't belong to any shard"""
+        shards, items = [prefix], []
+        for _ in range(self.conf.SHARD_DEPTH):
+            if len(shards) >= self.conf.LIST_WORKERS:
+                break
+            with ThreadPoolExecutor(max_workers=self.conf.LIST_WORKERS) as executor:
+                levels = list(executor.map(self.s3_list_level, shards))
+            shards = [sub_prefix for sub_prefixes, _ in levels for sub_prefix in sub_prefixes]
+            items += [item for _, level_items in levels for item in level_items]
+        return shards, items
+
+    def s3_objects_concurrently(self, prefixes, start_after=None):
+        """List every prefix from a pool of LIST_WORKERS threads and yield objects
+        as soon as they are listed, in no particular order. start_after can map
+        a prefix to the key after which to start listing it"""
+        start_after = start_after or {}
+        items = queue.Queue()
+        stop = threading.Event()
+
+        def list_prefix(prefix):
+            for item in self.s3_list_objects(prefix, start_after=start_after.get(prefix)):
+                if stop.is_set():
+                    return
+                items.put(item)
+
+        executor = ThreadPoolExecutor(max_workers=self.conf.LIST_WORKERS)
+        futures = [executor.submit(list_prefix, prefix) for prefix in prefixes]
+        # A finished future is put in the queue to signal its prefix is done
+        for future in futures:
+            future.add_done_callback(items.put)
+        try:
+            remaining = len(futures)
+            while remaining:
+                item = items.get()
+                if isinstance(item, Future):
+                    remaining -= 1
+                    item.result()
+                else:
+                    yield item
+        finally:
+            stop.set()
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def retry(self, fn, *args, **kwargs):
+        """Call fn, retrying with exponential backoff if S3 errors out.
+        Missing keys are not retried"""
+        for attempt in range(self.conf.RETRIES):
+            try:
+                return fn(*args, **kwargs)
+            except self.s3.exceptions.NoSuchKey:
+                raise
+            except (BotoCoreError, ClientError) as e:
+                if attempt == self.conf.RETRIES - 1:
+                    raise
+                delay = 2 ** attempt * (0.5 + random.random())
+                logging.debug(f'Retrying in {delay:.1f}s after error: {e}')
+                time.sleep(delay)
+
+    def download_concurrently(self, fn, items):
+        """Call fn on every item from a pool of DOWNLOAD_WORKERS threads,
+        which share the client's connection pool. Failures are logged once
+        all items are done. Returns the items that succeeded"""
+        done, failed = [], []
+        with ThreadPoolExecutor(max_workers=self.conf.DOWNLOAD_WORKERS) as executor:
+            futures = {executor.submit(self.retry, fn, item): item for item in items}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                item = futures[future]
+                try:
+                    future.result()
+                    done.append(item)
+                except Exception as e:
+                    failed.append(item)
+                    logging.error(f'Failed to download {item}: {e}')
+        if failed:
+            logging.error(f'{len(failed)} downloads failed, rerun to retry them')
+        return done
 
     def to_s3_key_str(self, s):
         s3key = []
@@ -135,20 +746,44 @@ class Database:
 
     def download_prefix(self):
         print('Getting all s3 keys...')
-        paths = list(self.s3_all_keys(self.conf.SNAP_PREFIX))
-        print(f'Found {len(paths)} files to download with prefix {self.conf.SNAP_PREFIX}')
-        for path in tqdm(paths):
-            local = os.path.join(self.conf.SNAP_DIR, path)
-            response = self.s3.get_object(Bucket=self.conf.BUCKET, Key=path)
-            os.makedirs(os.path.dirname(local), exist_ok=True)
-            _, extension = os.path.splitext(local)
-            if extension in self.conf.SNAP_ALLOWED_EXTS:
-                with open(local, 'wb') as f:
-                    f.write(response['Body'].read())
+        objects = [obj for obj in self.s3_all_objects(self.conf.SNAP_PREFIX)
+                   if os.path.splitext(obj['Key'])[1] in self.conf.SNAP_ALLOWED_EXTS]
+        print(f'Found {len(objects)} files to download with prefix {self.conf.SNAP_PREFIX}')
+        objects = [obj for obj in objects if not self.is_downloaded(obj)]
+        print(f'{len(objects)} of them are not yet downloaded')
+        self.download_concurrently(self.download_object, objects)
+
+    def local_snapshot_path(self, key):
+        return os.path.join(self.conf.SNAP_DIR, key)
+
+    def is_downloaded(self, obj):
+        """Check if an object from a listing already has an identical local copy.
+        Sizes are compared, and so are MD5 hashes unless the object was a multipart
+        upload, as the ETag of those isn't the MD5 of the object"""
+        local = self.local_snapshot_path(obj['Key'])
+        if not os.path.isfile(local) or os.path.getsize(local) != obj['Size']:
+            return False
+        etag = obj['ETag'].strip('"')
+        if '-' in etag:
+            return True
+        with open(local, 'rb') as f:
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: f.read(2**20), b''):
+                md5.update(chunk)
+        return md5.hexdigest() == etag
+
+    def download_object(self, obj):
+        local = self.local_snapshot_path(obj['Key'])
+        response = self.s3.get_object(Bucket=self.conf.BUCKET, Key=obj['Key'])
+        self.metrics.inc('s3_downloaded_bytes_total', response['ContentLength'])
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        with open(local, 'wb') as f:
+            shutil.copyfileobj(response['Body'], f)
 
     def download_helper(self, projects, filename_format=None, directory=None):
         """Main downloader method. Files will be downloaded to `directory` and be
-        named with `filename_format`.
+        named with `filename_format`. Submissions that were already downloaded
+        by a previous run and haven't changed since, are skipped.
 
         :param projects: What projects to download submissions for
         :param filename_format: what to rename the submission to.
@@ -157,18 +792,118 @@ class Database:
         :param directory: What directory to download them to. If None,
                 they will be downloaded to S3_DIR/s3path/
         """
-        submissions = set()
+        etags = {}
         print('Getting all s3 keys...')
         for p in projects:
-            submissions |= self.get_submissions(p, rerun=True)
-        print(f'Found {len(submissions)} files to download from {", ".join(projects)}')
-        for submission in tqdm(submissions):
+            for obj in self.s3_all_objects(self.conf.PREFIX + p + '/'):
+                if obj['Key'].endswith('/submission.json'):
+                    etags[obj['Key']] = obj['ETag']
+        print(f'Found {len(etags)} files to download from {", ".join(projects)}')
+
+        # ETags of the submissions downloaded by previous runs
+        ledger_path = os.path.join(directory or self.conf.S3_DIR, '.etags.json')
+        try:
+            with open(ledger_path, 'r', encoding='utf-8') as f:
+                ledger = json.load(f)
+        except FileNotFoundError:
+            ledger = {}
+        submissions = [s for s, etag in etags.items()
+                       if ledger.get(s, [None])[0] != etag or not os.path.exists(ledger[s][1])]
+        print(f'{len(submissions)} of them are new or changed')
+
+        lock = threading.Lock()
+
+        def download(submission):
             if filename_format is not None:
                 file_info = self.parse_s3path(submission)
                 filename = filename_format.format(**file_info)
             else:
                 filename = filename_format
-            self.fetch_submission(submission, filename=filename, directory=directory)
+            path = os.path.join(*self.fetch_submission(submission, filename=filename, directory=directory))
+            with lock:
+                ledger[submission] = [etags[submission], path]
+
+        try:
+            self.download_concurrently(download, submissions)
+        finally:
+            os.makedirs(os.path.dirname(ledger_path) or '.', exist_ok=True)
+            with open(ledger_path, 'w', encoding='utf-8') as f:
+                json.dump(ledger, f)
+
+    def generate_submissions(self, projects, students, per_student=3, size=2**14, seed=0):
+        """Put synthetic submissions, laid out like real ones, for benchmarking.
+        Each student submits per_student notebooks of about size bytes to every
+        project. The same seed always gives the same keys and submissions"""
+        rng = random.Random(seed)
+        start = datetime(2020, 2, 1)
+        submissions = []
+        for project in projects:
+            for student in range(students):
+                email = self.to_s3_key_str(f'student{student:04d}@wisc.edu')
+                for _ in range(per_student):
+                    date = start + timedelta(seconds=rng.randrange(30 * 24 * 3600))
+                    key = f'{self.conf.PREFIX}{project}/{email}/{date:%Y-%m-%d_%H-%M-%S}/submission.json'
+                    submissions.append((key, self.synthetic_notebook(rng, size)))
+
+        def put(submission):
+            key, notebook = submission
+            payload = base64.b64encode(notebook.encode('utf-8')).decode('ascii')
+            self.put_submission(key, json.dumps({'filename': 'main.ipynb', 'payload': payload}))
+        self.download_concurrently(put, submissions)
+        return [key for key, _ in submissions]
+
+    @staticmethod
+    def synthetic_notebook(rng, size):
+        """A notebook of random code cells, about size bytes long"""
+        cells, length = [], 0
+        while length < size:
+            lines = [f'x{i} = {rng.randrange(10**6)} * {rng.random():.6f}\n' for i in range(rng.randint(1, 20))]
+            cells.append({'cell_type': 'code', 'execution_count': None, 'metadata': {},
+                          'outputs': [], 'source': lines})
+            length += sum(map(len, lines)) + 100
+        return json.dumps({'cells': cells, 'metadata': {}, 'nbformat': 4, 'nbformat_minor': 2}, indent=1)
+
+    def benchmark(self, projects, upload=False):
+        """Time listing, fetching and optionally uploading results of every
+        submission of projects, returns the throughput of each step"""
+        report = {}
+
+        def timed(step, fn, counter=None):
+            t0 = time.time()
+            before = self.metrics.value(counter) if counter else 0
+            count = fn()
+            elapsed = time.time() - t0
+            moved = self.metrics.value(counter) - before if counter else 0
+            report[step] = {'count': count, 'seconds': round(elapsed, 3),
+                            'per_second': round(count / elapsed, 1) if elapsed else None,
+                            'MB_per_second': round(moved / 2**20 / elapsed, 2) if moved and elapsed else None}
+
+        submissions = []
+
+        def list_all():
+            for project in projects:
+                submissions.extend(self.get_submissions(project, rerun=True))
+            return len(submissions)
+        timed('list', list_all)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            def fetch(s3path):
+                directory = os.path.join(tmp_dir, hashlib.sha1(s3path.encode('utf-8')).hexdigest())
+                self.fetch_submission(s3path, directory=directory)
+            timed('fetch', lambda: len(self.download_concurrently(lambda s: self.retry(fetch, s), submissions)),
+                  's3_downloaded_bytes_total')
+        if upload:
+            def upload_all():
+                for s3path in submissions:
+                    key = s3path.replace('submission.json', 'test.json')
+                    self.put_submission_later(key, {'score': 100, 'tests': [], 'benchmark': True})
+                self.flush_uploads()
+                return len(submissions)
+            timed('upload', upload_all, 's3_uploaded_bytes_total')
+        return report
+
+    def save_index(self):
+        if self.index is not None:
+            self.index.save()
 
     def clear_caches(self):
         if self.conf.CLEANUP and os.path.exists(self.conf.S3_DIR):
@@ -196,10 +931,29 @@ if __name__ == '__main__':
                         help='filename format to use when downloading for moss')
     parser.add_argument('-p', '--prefix', type=str, default=argparse.SUPPRESS,
                         help='download prefix to use')
+    parser.add_argument('-w', '--download-workers', type=int, default=argparse.SUPPRESS,
+                        help='number of files to download concurrently')
+    parser.add_argument('-be', '--backend', type=str, choices=['s3', 'local'], default=argparse.SUPPRESS,
+                        help='store objects in s3 or in local files under LOCAL_ROOT')
+    parser.add_argument('-gs', '--generate', type=int, metavar='STUDENTS', default=None,
+                        help='put synthetic submissions of this many students to the projects, '
+                             'only with the local backend')
+    parser.add_argument('-b', '--benchmark', action='store_true', default=False,
+                        help='time listing and fetching the submissions of the projects, and uploading '
+                             'results with the local backend')
 
     database_args = parser.parse_args()
     d = Database(**vars(database_args))
 
+    if database_args.generate:
+        if d.conf.BACKEND != 'local':
+            parser.error('synthetic submissions can only be generated with the local backend')
+        keys = d.generate_submissions(database_args.projects, database_args.generate)
+        print(f'Generated {len(keys)} submissions in {d.conf.LOCAL_ROOT}')
+    if database_args.benchmark:
+        report = d.benchmark(database_args.projects, upload=d.conf.BACKEND == 'local')
+        print(json.dumps(report, indent=2))
+
     if database_args.download_all:
         d.download_all(database_args.projects)
     elif database_args.download_moss:
@@ -0,0 +1,71 @@
+import io
+import json
+import base64
+import random
+import unittest
+
+from s3interface import SubmissionStream
+
+
+def escape(text, rand):
+    """Escape some characters of a json string the ways json allows"""
+    escaped = ''
+    for char in text:
+        kind = rand.randrange(8)
+        if char == '/' and kind == 0:
+            escaped += '\\/'
+        elif char == '\n':
+            escaped += '\\n'
+        elif kind == 1:
+            escaped += f'\\u{ord(char):04x}'
+        else:
+            escaped += char
+        if kind == 2:
+            escaped += rand.choice(['\\n', '\\r\\n', '\\t', ' '])
+    return escaped
+
+
+def spaces(rand):
+    return ''.join(rand.choice(' \t\r\n') for _ in range(rand.randrange(3)))
+
+
+class SubmissionStreamTest(unittest.TestCase):
+    """Streaming a submission must give what json and b64decode do"""
+
+    def random_submission(self, rand):
+        payload = bytes(rand.randrange(256) for _ in range(rand.randrange(300)))
+        encoded = base64.b64encode(payload).decode()
+        if rand.random() < 0.5:
+            # Wrapped like MIME base64
+            encoded = '\n'.join(encoded[i:i + 76] for i in range(0, len(encoded), 76))
+        fields = {'project': 'p1', 'netid': 'bucky', 'score': rand.choice([0, 95.5, 1.5e10, -12345678901234567890]),
+                  'late': rand.choice([True, False, None]), 'tags': ['a', 'é✓', {'n': 3e-5}],
+                  'note': 'quote " backslash \\ slash /'}
+        items = [(key, json.dumps(value)) for key, value in fields.items()]
+        items.insert(rand.randrange(len(items) + 1), ('payload', f'"{escape(encoded, rand)}"'))
+        body = '{' + ','.join(f'{spaces(rand)}"{key}"{spaces(rand)}:{spaces(rand)}{value}{spaces(rand)}'
+                              for key, value in items) + '}'
+        return body.encode('utf-8'), fields, payload
+
+    def test_random_submissions(self):
+        rand = random.Random(11)
+        for _ in range(500):
+            body, fields, payload = self.random_submission(rand)
+            # Small chunks split numbers, escapes and utf-8 characters
+            chunk_size = rand.choice([1, 2, 3, 5, 7, 16, 64, 2**16])
+            out = io.BytesIO()
+            parsed = SubmissionStream(io.BytesIO(body), chunk_size).parse(out)
+            self.assertEqual(parsed, fields, body)
+            self.assertEqual(out.getvalue(), payload, body)
+            self.assertEqual(out.getvalue(), base64.b64decode(json.loads(body)['payload']), body)
+
+    def test_number_split_across_chunks(self):
+        body = b'{"score": 1.5e10, "payload": "' + base64.b64encode(b'code') + b'"}'
+        for chunk_size in range(1, len(body) + 1):
+            out = io.BytesIO()
+            self.assertEqual(SubmissionStream(io.BytesIO(body), chunk_size).parse(out), {'score': 1.5e10})
+            self.assertEqual(out.getvalue(), b'code')
+
+
+if __name__ == '__main__':
+    unittest.main()
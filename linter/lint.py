@@ -1,13 +1,43 @@
 import re
 import os
+import ast
+import sys
+import json
+import hashlib
+import builtins
+import symtable
+import inspect
 import argparse
+import tempfile
+from io import BytesIO, TextIOWrapper
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 import nbformat
 import numpy as np
-from pylint import epylint
+import pylint
+from pylint.lint import Run
+from pylint.reporters import BaseReporter
 import astroid
 
+# Where pylint's messages are cached, None to disable caching
+CACHE_DIR = os.environ.get('LINT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'cs320-lint'))
+CACHE_MAX_BYTES = 64 * 2**20
+# Bump when a change to this file makes cached messages stale
+CACHE_VERSION = 3
+# Messages about the start (missing docstring) and end (final newlines) of
+# a module, which linting a subset of the cells gets wrong
+MODULE_START_MESSAGES = ('C0114',)
+MODULE_END_MESSAGES = ('C0304', 'C0305')
+# Messages about the whole module (too many lines), which are never cached
+# per cell and come from linting every cell with only their checks enabled
+MODULE_MESSAGES = ('C0302',)
+# A reference to another line of the script in a message, like W0404's
+# "Reimport 'os' (imported line 3)", and how cached messages store it: by
+# the signature of the referenced cell and the line in that cell
+LINE_REF = re.compile(r'\bline (\d+)\b')
+CELL_LINE_REF = re.compile(r'\bline ([0-9a-f]{64}):(\d+)\b')
+
 
 class LintMessage:
     """A simple data container for each linting message"""
@@ -37,6 +67,15 @@ class LintMessage:
                 obj.data = source[obj.line]
         return objects
 
+    @classmethod
+    def from_pylint(cls, message, source=None):
+        # From a message given to a pylint reporter
+        obj = cls(message.path, (message.line or 1) - 1, message.category, message.msg_id,
+                  message.symbol, message.obj, message.msg)
+        if source and obj.line < len(source):
+            obj.data = source[obj.line]
+        return obj
+
     def __str__(self):
         # Note: cell, line are zero indexed internally but starts at 1
         if self.cell is not None:
@@ -49,21 +88,138 @@ class LintMessage:
         return p
 
 
+class LintMessageReporter(BaseReporter):
+    """Pylint reporter that collects LintMessages instead of printing"""
+    name = 'lintmessages'
+
+    def __init__(self, source=None):
+        super().__init__()
+        self.source, self.lint_messages = source, []
+
+    def handle_message(self, msg):
+        self.lint_messages.append(LintMessage.from_pylint(msg, source=self.source))
+
+    def display_messages(self, layout):
+        pass
+
+    def _display(self, layout):
+        pass
+
+
+class LintCache:
+    """Size bounded on-disk store of pylint's messages keyed by a hash of the
+    linted source, its file name, the pylint options and the versions of
+    python, pylint and astroid. When the store grows past max_bytes the least
+    recently used entries are evicted, a hit refreshes the modification time
+    of its file. Options read from a pylintrc are not part of the key, lint
+    with cache_dir=None after changing one. The cache is skipped, not fatal,
+    when its directory can't be written."""
+
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES):
+        self.directory, self.max_bytes = directory, max_bytes
+
+    def key(self, name, source, args):
+        versions = [CACHE_VERSION, sys.version_info[:2], pylint.__version__, astroid.__version__]
+        blob = json.dumps([versions, name, args, source])
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        """Return the messages stored under key, or None if there are none"""
+        path = self.path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                msgs = [LintMessage(**msg) for msg in json.load(f)]
+            os.utime(path)
+        except (OSError, ValueError, TypeError):
+            return None
+        return msgs
+
+    def put(self, key, msgs):
+        """Store msgs under key, then evict old entries if needed"""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump([vars(msg) for msg in msgs], f)
+            os.replace(tmp_path, self.path(key))
+            self.evict()
+        except OSError:
+            pass
+
+    def evict(self):
+        """Remove least recently used entries until the store fits in max_bytes"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def run_pylint(args, reporter, source=None):
+    """Run pylint in this process, without exiting when it is done. If
+    source is given it is linted as the content of the file args[0], which
+    doesn't need to exist, by feeding it to pylint as its standard input"""
+    stdin = sys.stdin
+    if source is not None:
+        args = args[:1] + ['--from-stdin'] + args[1:]
+        sys.stdin = TextIOWrapper(BytesIO(source.encode('utf-8')), encoding='utf-8')
+    try:
+        if 'exit' in inspect.signature(Run.__init__).parameters:
+            Run(args, reporter=reporter, exit=False)
+        else:
+            # Before pylint 2.5 this was called do_exit
+            Run(args, reporter=reporter, do_exit=False)
+    finally:
+        sys.stdin = stdin
+    # Forget the linted file, astroid would reuse its old tree if it changed
+    path = os.path.abspath(args[0])
+    for name, module in list(astroid.MANAGER.astroid_cache.items()):
+        if module.file and os.path.abspath(module.file) == path:
+            del astroid.MANAGER.astroid_cache[name]
+
+
 class ScriptLinter:
-    def __init__(self, path, verbose=False):
+    def __init__(self, path, verbose=False, cache_dir=CACHE_DIR):
         self.path, self.verbose = path, verbose
+        self.cache = LintCache(cache_dir) if cache_dir else None
 
-    def lint_script(self):
-        """Call pylint and create LintMessages for each msg"""
-        with open(self.path, 'r', encoding='utf-8') as f:
-            source = f.read().splitlines()
-        cmd = self.path + ' --persistent=no --score=no'
-        pylint_stdout, pylint_stderr = epylint.py_run(cmd, return_std=True)
-        stdout = pylint_stdout.getvalue()
-        stderr = pylint_stderr.getvalue()
-        if stderr:
-            print(stderr)
-        return LintMessage.from_stdout(stdout, source=source)
+    pylint_args = ['--persistent=no', '--score=no', '--reports=no']
+
+    def lint_script(self, source=None, path=None, args=()):
+        """Run pylint, its reporter creates LintMessages for each msg.
+        If source is given it's linted in memory, as the content of path.
+        Extra pylint options can be given in args. Unchanged sources are
+        answered from the cache"""
+        path = path or self.path
+        text = source
+        if text is None:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+        args = self.pylint_args + list(args)
+        if self.cache is not None:
+            key = self.cache.key(os.path.basename(path), text, args)
+            msgs = self.cache.get(key)
+            if msgs is not None:
+                for msg in msgs:
+                    msg.path = path
+                return msgs
+        reporter = LintMessageReporter(source=text.splitlines())
+        run_pylint([path] + args, reporter, source=source)
+        if self.cache is not None:
+            self.cache.put(key, reporter.lint_messages)
+        return reporter.lint_messages
 
     def filter_messages(self, msgs):
         """Filter messages based on verbosity"""
@@ -83,58 +239,294 @@ class ScriptLinter:
         return msgs
 
 
+def cell_names(source):
+    """Names a cell defines at the top level or declares global, names it
+    uses, names it binds anywhere, shadowing those of other cells, names it
+    deletes at the top level and names it sets attributes or items of"""
+    try:
+        tree = ast.parse(source)
+        table = symtable.symtable(source, '<cell>', 'exec')
+    except SyntaxError:
+        return set(), set(), set(), set(), set()
+    # Names looked up in the module, not those local to a function
+    used, todo = set(), [table]
+    while todo:
+        table = todo.pop()
+        used.update(symbol.get_name() for symbol in table.get_symbols() if symbol.is_referenced()
+                    and (table.get_type() == 'module' or symbol.is_global()))
+        todo.extend(table.get_children())
+    bound, mutated = set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Attribute, ast.Subscript)) \
+                and isinstance(node.ctx, (ast.Store, ast.Del)):
+            # Setting an attribute or item of a name doesn't bind it, but
+            # changes what pylint infers it holds
+            root = node
+            while isinstance(root, (ast.Attribute, ast.Subscript)):
+                root = root.value
+            if isinstance(root, ast.Name):
+                mutated.add(root.id)
+        elif isinstance(node, ast.Name):
+            if isinstance(node.ctx, (ast.Store, ast.Del)):
+                bound.add(node.id)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            bound.update((alias.asname or alias.name).split('.')[0] for alias in node.names)
+    defined, deleted, todo = set(), set(), list(tree.body)
+    while todo:
+        node = todo.pop()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            defined.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            defined.update((alias.asname or alias.name).split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            defined.add(node.id)
+        elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Del):
+            deleted.add(node.id)
+        elif not isinstance(node, (ast.Lambda, ast.GeneratorExp, ast.ListComp,
+                                   ast.SetComp, ast.DictComp)):
+            todo.extend(ast.iter_child_nodes(node))
+    # Functions can define globals too
+    defined.update(name for node in ast.walk(tree) if isinstance(node, ast.Global)
+                   for name in node.names)
+    return defined, used, bound, deleted, mutated
+
+
+def cell_statements(source):
+    """Kind of each top level statement of a cell, with the imports made in
+    it outside of functions and classes"""
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return []
+    statements = []
+    for node in tree.body:
+        # Before python 3.8 strings were parsed to ast.Str, with an s field
+        value = getattr(node, 'value', None)
+        value = getattr(value, 'value', getattr(value, 's', None))
+        if isinstance(node, ast.Expr) and isinstance(value, str):
+            kind = 'String'
+        else:
+            kind = type(node).__name__
+        imports = [] if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) \
+            else [ast.dump(n) for n in ast.walk(node) if isinstance(n, (ast.Import, ast.ImportFrom))]
+        statements.append((kind, imports))
+    return statements
+
+
 class NotebookLinter(ScriptLinter):
-    def __init__(self, path, cleanup=True, verbose=False):
-        super().__init__(path, verbose=verbose)
+    """Lints the code cells of a notebook joined into a script. The script
+    is only kept in memory, pylint sees it as a .py next to the notebook"""
+    def __init__(self, path, verbose=False, cache_dir=CACHE_DIR, incremental=False):
+        super().__init__(path, verbose=verbose, cache_dir=cache_dir)
+        self.script_path = path[:-len('.ipynb')] + '.py'
         self.cell_lines = []
-        self.cleanup = cleanup
+        # Incremental linting keeps the messages of each cell in the cache
+        self.incremental = incremental and self.cache is not None
         if not path.endswith('.ipynb'):
             raise ValueError('File needs to be a IPython Notebook (.ipynb)')
 
-    def lint_notebook(self):
+    def lint_notebook(self, cells=None, args=()):
         """Lint the generated script and map the massages to their
-        corresponding cell/line number in the notebook"""
-        cell_start_line, _ = self.notebook_mapping()
-        lint_msgs = self.lint_script()
-        if self.cleanup:
-            os.remove(self.path)
+        corresponding cell/line number in the notebook. Only the cells
+        with the given indices are linted if cells isn't None. Extra
+        pylint options can be given in args"""
+        source, cell_start_line, _ = self.notebook_mapping(cells)
+        lint_msgs = self.lint_script(source, self.script_path, args)
         valid_lint_msgs = []
         for lint_msg in lint_msgs:
             try:
-                line_offset = int(lint_msg.line) - cell_start_line
-                line_offset[line_offset < 0] = line_offset.max()
-                cell_num = np.argmin(line_offset)
-                cell_line = line_offset[cell_num]
-                lint_msg.cell = cell_num
-                lint_msg.line = cell_line
+                cell_num, lint_msg.line = self.locate(lint_msg.line, cell_start_line)
+                lint_msg.cell = cell_num if cells is None else cells[cell_num]
                 valid_lint_msgs.append(lint_msg)
             except ValueError:
                 pass
         return valid_lint_msgs
 
-    def notebook_mapping(self):
-        """Map script lines to notebook cell/line number"""
-        self.path = self.notebook2script()
+    @staticmethod
+    def locate(line, cell_start_line):
+        """Map a (zero indexed) line of the script to its cell and the line
+        in that cell"""
+        line_offset = int(line) - cell_start_line
+        line_offset[line_offset < 0] = line_offset.max()
+        cell_num = int(np.argmin(line_offset))
+        return cell_num, int(line_offset[cell_num])
+
+    def lint_incremental(self):
+        """Lint only the cells whose signature changed since they were
+        last linted, along with the cells they need for context. The other
+        cells reuse the messages they got then, from the cache"""
+        self.read_cells()
+        signatures, definers, users, neighbours = self.cell_signatures()
+        cell_of = {signature: cell for cell, signature in enumerate(signatures)}
+        starts = self.cell_start_lines(range(len(self.cells)))
+        name = os.path.basename(self.path)
+        keys = [self.cache.key(name, signature, self.pylint_args) for signature in signatures]
+        cell_msgs, stale = {}, []
+        for cell, key in enumerate(keys):
+            msgs = self.cache.get(key)
+            if msgs is None or not self.resolve_line_refs(msgs, cell_of, starts):
+                stale.append(cell)
+            else:
+                for msg in msgs:
+                    msg.cell = cell
+                cell_msgs[cell] = msgs
+        if stale:
+            # Lint the stale cells with the cells defining the names they use
+            # (recursively), the cells using the names they define and the
+            # cells holding the statements around them
+            context = set(stale).union(*(users[cell] for cell in stale))
+            todo = list(context)
+            while todo:
+                for cell in definers[todo.pop()] - context:
+                    context.add(cell)
+                    todo.append(cell)
+            context = sorted(context.union(*(neighbours[cell] for cell in stale)))
+            lint_msgs = self.lint_notebook(context)
+            # Messages about the start and end of the module are only right
+            # for the first and last cells of the notebook
+            last = len(self.cells) - 1
+            lint_msgs = [msg for msg in lint_msgs
+                         if not (msg.msg_id in MODULE_START_MESSAGES and msg.cell != 0
+                                 or msg.msg_id in MODULE_END_MESSAGES and msg.cell != last
+                                 or msg.msg_id in MODULE_MESSAGES)]
+            # Lines of this script aren't those of the whole notebook, refer
+            # to them by cell until the messages are shown
+            context_starts = self.cell_start_lines(context)
+            for msg in lint_msgs:
+                msg.msg = LINE_REF.sub(lambda ref: self.cell_line_ref(
+                    int(ref.group(1)) - 1, context, context_starts, signatures), msg.msg)
+            for cell in stale:
+                cell_msgs[cell] = [msg for msg in lint_msgs if msg.cell == cell]
+            # A syntax error hides every other message, don't cache those
+            if not any(msg.msg_id == 'E0001' or msg.category == 'fatal' for msg in lint_msgs):
+                for cell in stale:
+                    self.cache.put(keys[cell], cell_msgs[cell])
+            for cell in stale:
+                self.resolve_line_refs(cell_msgs[cell], cell_of, starts)
+        args = ['--disable=all', '--enable=' + ','.join(MODULE_MESSAGES)]
+        for msg in self.lint_notebook(list(range(len(self.cells))), args):
+            if msg.msg_id in MODULE_MESSAGES:
+                cell_msgs.setdefault(msg.cell, []).append(msg)
+        return [msg for cell in sorted(cell_msgs) for msg in cell_msgs[cell]]
+
+    def cell_line_ref(self, line, cells, cell_start_line, signatures):
+        """Refer to a (zero indexed) line of the script made of the given
+        cells by the signature of its cell and the line in that cell"""
+        cell_num, cell_line = self.locate(line, cell_start_line)
+        return f'line {signatures[cells[cell_num]]}:{cell_line}'
+
+    @staticmethod
+    def resolve_line_refs(msgs, cell_of, cell_start_line):
+        """Turn the references by cell in the messages back into lines of the
+        notebook's script. Returns False if a referenced cell is gone"""
+        def line(ref):
+            return f'line {cell_start_line[cell_of[ref.group(1)]] + int(ref.group(2)) + 1}'
+        try:
+            for msg in msgs:
+                msg.msg = CELL_LINE_REF.sub(line, msg.msg)
+        except KeyError:
+            return False
+        return True
+
+    def cell_start_lines(self, cells):
+        """The (zero indexed) line each of the given cells starts at in the
+        script made of them"""
+        cell_lines = np.array([len(self.cells[cell].split('\n')) for cell in cells], dtype=int)
+        return np.cumsum(cell_lines) - cell_lines
+
+    def cell_signatures(self):
+        """Hash each cell together with the signatures of the earlier cells
+        defining names it uses, the names it uses that later cells define or
+        delete, the names it defines that other cells use and the statements
+        around it that pylint's checks look at. When a cell changes the
+        signatures of the cells using its names change too. Also returns, for
+        each cell, the set of other cells defining names it uses, the set of
+        other cells using names it defines and the set of other cells holding
+        the statements around it"""
+        cells = [self.comment_jupyter_magics(cell) for cell in self.cells]
+        names = [cell_names(cell) for cell in cells]
+        statements = [cell_statements(cell) for cell in cells]
+        touched = [defined | used | bound for defined, used, bound, _, _ in names]
+        definers = [{i for i, (defined, _, _, deleted, mutated) in enumerate(names)
+                     if i != cell and (defined | deleted | mutated) & touched[cell]}
+                    for cell in range(len(cells))]
+        users = [{i for i in range(len(cells)) if cell in definers[i]} for cell in range(len(cells))]
+        with_statements = [cell for cell in range(len(cells)) if statements[cell]]
+        docstring = bool(with_statements) and statements[with_statements[0]][0][0] == 'String'
+        if docstring:
+            statements[with_statements[0]][0] = ('Docstring', [])
+        imports = [[imported for _, stmt_imports in cell_statements for imported in stmt_imports]
+                   for cell_statements in statements]
+        # Names used before any cell defined them, pylint only reports the
+        # first use of each
+        known = set(dir(builtins))
+        undefined = [used - known - set().union(*(names[i][0] for i in range(cell)))
+                     for cell, (_, used, _, _, _) in enumerate(names)]
+        signatures, neighbours, last = [], [], len(cells) - 1
+        for cell, (defined, _, _, _, _) in enumerate(names):
+            # In order, since a name deleted before being defined again is
+            # undefined, one defined later only used before assignment
+            bound_later = [[name, name in names[i][0], name in names[i][3]]
+                           for i in range(cell + 1, len(cells))
+                           for name in sorted(touched[cell] & (names[i][0] | names[i][3]
+                                                               | names[i][4]))]
+            used_by_others = set().union(*(names[i][1] for i in users[cell]))
+            undefined_before = [i for i in range(cell) if undefined[i] & undefined[cell]]
+            reported = set().union(*(undefined[i] for i in undefined_before))
+            # A string after an assignment documents it, a pass is only
+            # needed if there is nothing else
+            before = [i for i in with_statements if i < cell]
+            after = [i for i in with_statements if i > cell]
+            others = any(kind != 'Docstring' for i in before + after for kind, _ in statements[i])
+            neighbours.append(set(before[-1:] + after[:1] + undefined_before))
+            layout = [statements[before[-1]][-1][0] if before else None, others,
+                      sorted(undefined[cell] & reported)]
+            if imports[cell]:
+                # Imports come before (some kinds of) other statements, ordered
+                # and grouped. Keep the first cell with each kind of statement
+                kinds = {}
+                for i in reversed(before):
+                    kinds.update((kind, i) for kind, _ in statements[i])
+                neighbours[cell].update(i for i in before if imports[i])
+                neighbours[cell].update(kinds.values())
+                layout += [[imported for i in before for imported in imports[i]], sorted(kinds)]
+            if cell == 0:
+                layout.append(docstring)
+            blob = json.dumps([self.cells[cell], cell == 0, cell == last,
+                               sorted(defined & used_by_others),
+                               bound_later, layout,
+                               [signatures[i] for i in sorted(definers[cell]) if i < cell]])
+            signatures.append(hashlib.sha256(blob.encode('utf-8')).hexdigest())
+        return signatures, definers, users, neighbours
+
+    def notebook_mapping(self, cells=None):
+        """Convert the notebook to a script and map its lines to
+        notebook cell/line number"""
+        source = self.notebook2script(cells=cells)
         cell_end_lines = np.cumsum(self.cell_lines)
-        return cell_end_lines-self.cell_lines, cell_end_lines-1
+        return source, cell_end_lines-self.cell_lines, cell_end_lines-1
 
-    def notebook2script(self, script_path=None):
+    def read_cells(self):
         """Read in notebook, convert to NotebookNode object then
-        traverse nodes and join their code together to get the source"""
-        if not script_path:
-            script_path = self.path.replace('.ipynb', '.py')
-        if os.path.isfile(script_path):
-            raise IOError(f'File {script_path} exists already, please delete or rename')
+        keep the source of its non empty code cells"""
         with open(self.path, 'r', encoding='utf-8') as f:
             nb = nbformat.read(f, as_version=nbformat.NO_CONVERT)
         self.cells = [cell['source'] for cell in nb['cells']
                       if cell['cell_type'] == 'code' and cell['source']]
-        source = self.comment_jupyter_magics('\n'.join(self.cells))
-        with open(script_path, 'w', encoding='utf-8') as f:
-            f.write(source)
-        self.cell_lines = [len(cell.split('\n')) for cell in self.cells]
+
+    def notebook2script(self, cells=None):
+        """Read in the notebook then join the code of its cells (or only
+        those with the given indices) together to get the source"""
+        if cells is None:
+            self.read_cells()
+            cells = range(len(self.cells))
+        sources = [self.cells[cell] for cell in cells]
+        source = self.comment_jupyter_magics('\n'.join(sources))
+        self.cell_lines = [len(cell.split('\n')) for cell in sources]
         self.cell_lines = np.array(self.cell_lines)
-        return script_path
+        return source
 
     def comment_jupyter_magics(self, source):
         """Commments out jupyter magics"""
@@ -179,40 +571,90 @@ class NotebookLinter(ScriptLinter):
         return list(msgs)
 
     def run(self):
-        msgs = self.lint_notebook()
+        msgs = self.lint_incremental() if self.incremental else self.lint_notebook()
         msgs = self.filter_messages(msgs)
         return msgs
 
 
-def lint(path, *args, show=True, debug=False, **kwargs):
+def lint(path, *args, show=True, debug=False, incremental=False, **kwargs):
     if path.endswith('.ipynb'):
-        linter = NotebookLinter(path, *args, **kwargs)
+        linter = NotebookLinter(path, *args, incremental=incremental, **kwargs)
     else:
         linter = ScriptLinter(path, *args, **kwargs)
     msgs = linter.run()
     if show:
-        if not msgs:
-            print('No linting messages to show!')
-        msg_types = defaultdict(list)
-        for msg in msgs:
-            msg_types[msg.category].append(msg)
-        for msg_type, msgs in msg_types.items():
-            print(f'{msg_type.title()} Messages:')
-            for msg in msgs:
-                print(msg.full_str(indent=2) if debug else '  ' + str(msg))
-            print()
+        show_messages(msgs, debug=debug)
         return None
     return msgs
 
 
+def show_messages(msgs, debug=False):
+    if not msgs:
+        print('No linting messages to show!')
+    msg_types = defaultdict(list)
+    for msg in msgs:
+        msg_types[msg.category].append(msg)
+    for msg_type, msgs in msg_types.items():
+        print(f'{msg_type.title()} Messages:')
+        for msg in msgs:
+            print(msg.full_str(indent=2) if debug else '  ' + str(msg))
+        print()
+
+
+def lint_quietly(path, args, kwargs):
+    """Lint a file in a worker process of lint_many"""
+    try:
+        return lint(path, *args, show=False, **kwargs), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+
+def lint_many(paths, *args, jobs=None, **kwargs):
+    """Lint many scripts and notebooks, spread over `jobs` processes (one
+    per cpu by default). Each process lints many files in turn, so the modules
+    they import are only parsed by astroid once per process. Returns a dict of
+    the messages of each path, None for files that couldn't be linted"""
+    paths = list(paths)
+    jobs = jobs or os.cpu_count() or 1
+    results = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # Hand out files in chunks, a few per process, to limit round trips
+        chunksize = max(1, len(paths) // (4 * jobs))
+        linted = executor.map(lint_quietly, paths, [args] * len(paths), [kwargs] * len(paths),
+                              chunksize=chunksize)
+        for path, (msgs, error) in zip(paths, linted):
+            if error is not None:
+                print(f'Could not lint {path}: {error}', file=sys.stderr)
+            results[path] = msgs
+    return results
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Linter for CS320')
     parser.add_argument('-d', '--debug', action='store_true',
                         help='Extra information about the linting message')
-    parser.add_argument('path', type=str, help='path of file to lint (.ipynb or .py)')
+    parser.add_argument('paths', type=str, nargs='+', metavar='path',
+                        help='path of file(s) to lint (.ipynb or .py)')
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='by default don\'t show warnings nor convention'
                              ' messages, enable with -v and -vv respectively')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of processes used to lint many files, one per cpu by default')
+    parser.add_argument('--cache-dir', type=str, default=CACHE_DIR,
+                        help=f'where linting messages are cached (default: {CACHE_DIR})')
+    parser.add_argument('--no-cache', dest='cache_dir', action='store_const', const=None,
+                        help='lint every file again, ignoring the cache')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='only lint the notebook cells that changed since they were last linted')
 
     grader_args = parser.parse_args()
-    lint(**vars(grader_args))
+    options = dict(verbose=grader_args.verbose, cache_dir=grader_args.cache_dir,
+                   incremental=grader_args.incremental)
+    if len(grader_args.paths) == 1:
+        lint(grader_args.paths[0], debug=grader_args.debug, **options)
+    else:
+        all_msgs = lint_many(grader_args.paths, jobs=grader_args.jobs, **options)
+        for path, msgs in all_msgs.items():
+            if msgs is not None:
+                print(f'==> {path} <==')
+                show_messages(msgs, debug=grader_args.debug)
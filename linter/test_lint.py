@@ -0,0 +1,113 @@
+import os
+import random
+import tempfile
+import unittest
+
+import nbformat
+
+import lint
+
+
+def messages(msgs):
+    return sorted((msg.cell, msg.line, msg.msg_id, msg.msg) for msg in msgs)
+
+
+class IncrementalLintTest(unittest.TestCase):
+    """Incremental linting must report exactly what a full lint does"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'main.ipynb')
+        self.cache_dir = os.path.join(self.tmp.name, 'cache')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def check(self, cells):
+        """Lint the cells incrementally and in full, for each verbosity"""
+        nb = nbformat.v4.new_notebook()
+        nb.cells = [nbformat.v4.new_code_cell(cell) for cell in cells]
+        nbformat.write(nb, self.path)
+        for verbose in (0, 2):
+            full = lint.lint(self.path, show=False, verbose=verbose, cache_dir=None)
+            incremental = lint.lint(self.path, show=False, verbose=verbose,
+                                    cache_dir=self.cache_dir, incremental=True)
+            self.assertEqual(messages(incremental), messages(full), cells)
+
+    def test_global_statement(self):
+        cells = ['def setup():\n    global total\n    total = 0', 'setup()', 'print(total)']
+        self.check(cells)
+        self.check(cells[:2] + ['print(total + 1)'])
+
+    def test_module_docstring_and_final_newline(self):
+        cells = ['"""Docs"""\nimport os', 'print(os.sep)', 'x = 1\n']
+        self.check(cells)
+        self.check(['import os'] + cells[1:])
+        self.check(['import os', 'print(os.sep)\n', 'x = 2'])
+        self.check(['import os', 'print(os.sep)\n', 'x = 2', 'y = 3\n\n'])
+
+    def test_deleted_name(self):
+        cells = ['print(x)', 'x = 1', 'del x']
+        self.check(cells)
+        self.check(['print(x)', 'del x', 'x = 1'])
+
+    def test_attribute_set_in_another_cell(self):
+        cells = ['class A:\n    pass', 'A.x = 1', 'print(A.x)']
+        self.check(cells)
+        self.check(['class A:\n    pass', 'A.y = 1', 'print(A.x)'])
+        self.check(['d = {}', 'd["k"] = A', 'print(d["k"].x)'])
+
+    def test_too_many_lines(self):
+        cells = ['import os', 'print(os.sep)', 'x = 1']
+        self.check(cells)
+        self.check(cells[:2] + ['\n'.join(f'x = {i}' for i in range(1000))])
+        self.check(cells[:2] + ['\n'.join(f'x = {i}' for i in range(900))])
+
+    def test_redefined_outer_name(self):
+        cells = ['def double(x):\n    return 2 * x', 'x = 1', 'print(double(x))']
+        self.check(cells)
+        self.check(['def double(x):\n    return x + x'] + cells[1:])
+        self.check(['def double(x):\n    return x + x', 'y = 1', 'print(double(y))'])
+        self.check(['def double(x):\n    return x + x', 'x = 1', 'print(double(y))'])
+
+    def test_imports(self):
+        cells = ['import os', 'x = 1', 'import sys\nprint(sys.argv)', 'def f():\n    import os\n    return os']
+        self.check(cells)
+        self.check(cells[:3] + ['print(os.sep)'])
+        self.check(['import nbformat'] + cells[1:])
+        self.check(['import nbformat', 'import os'] + cells[2:])
+
+    def test_statements_around(self):
+        cells = ['x = 1', '"""Documents x"""', 'pass']
+        self.check(cells)
+        self.check(['print(1)'] + cells[1:])
+        self.check(['"""Docs"""'])
+        self.check(['"""Docs"""', 'pass'])
+
+    def test_random_edits(self):
+        snippets = ['import os', 'import sys', 'x = 1', 'y = x + 1', 'print(x, y)',
+                    'def f(x):\n    return x', 'def g():\n    global z\n    z = 3',
+                    'print(z)', 'print(f(y))', 'print(os.sep)', 'import os\nos.getcwd()',
+                    '"""Docs"""', '%matplotlib inline', 'total = sum(range(x))\n', 'pass',
+                    'import nbformat', 'from os import path', 'def h(df):\n    import os\n    return df',
+                    'try:\n    import json\nexcept ImportError:\n    json = None', 'df = 5\nprint(h(df))',
+                    'class A:\n    x = 1', 'for x in range(3):\n    print(x)', 'del x',
+                    'A.y = 2', 'print(A.y)', 'x[0] = y']
+        rand = random.Random(320)
+        cells = [rand.choice(snippets) for _ in range(6)]
+        for _ in range(20):
+            edit = rand.randrange(4)
+            if edit == 0:
+                cells[rand.randrange(len(cells))] = rand.choice(snippets)
+            elif edit == 1:
+                cells.insert(rand.randrange(len(cells) + 1), rand.choice(snippets))
+            elif edit == 2 and len(cells) > 2:
+                cells.pop(rand.randrange(len(cells)))
+            else:
+                cell = rand.randrange(len(cells))
+                cells[cell] += '\n' + rand.choice(snippets)
+            self.check(cells)
+
+
+if __name__ == '__main__':
+    unittest.main()